@@ -0,0 +1,122 @@
+import argparse
+import os
+
+import numpy as np
+
+from preprocessing import chunk_tracks, compress, count_chunks, label_encoder, load_stats, n_samples, norm_moments, \
+    spec_len, spectrograms
+from train import load_cnn, vote
+
+genres = sorted(label_encoder, key=label_encoder.get)
+extensions = ('.au', '.wav', '.mp3', '.flac', '.ogg')
+
+
+def list_audio(paths):
+    """
+    List the audio files to be classified. Directories are walked in sorted order.
+
+    :param paths: list, paths to audio files or directories containing audio files.
+    :return: list, paths to the audio files.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(root + '/' + name for name in sorted(names) if name.lower().endswith(extensions))
+        else:
+            files.append(path)
+    return files
+
+
+def batches(files, batch_files=64, workers=None, cache_dir=None, hop=None, chunk_size=80,
+            stats_path='./models/norm_stats.npz'):
+    """
+    Compute the normalized chunks of the files, grouped so that the chunks of many files are predicted together. The
+    normalization statistics of the train set are read once, before the first batch.
+
+    :param files: list, paths to the audio files.
+    :param batch_files: int, number of files per batch. Default is 64.
+    :param workers: int, number of worker processes computing the mel-spectrograms. Default is None, which uses all
+    the cores.
+    :param cache_dir: string, directory of the spectrogram cache. Default is None, which disables the cache.
+    :param hop: int, number of frames between the start of consecutive chunks. Default is None, which gives
+    non-overlapping chunks.
+    :param chunk_size: int, number of frames per chunk. Default is 80.
+    :param stats_path: string, path to the normalization statistics of the train set, see preprocessing.save_stats().
+    Default is './models/norm_stats.npz'.
+    :return: generator, yielding tuples of the files of the batch and their chunks, files * n_chunks x 40 x chunk_size
+    x 1.
+    """
+    stats, band_stats, metadata = load_stats(stats_path)
+    mean, std = norm_moments(stats, band_stats, metadata['mode'])
+    names = []
+    spec = []
+    # the spectrograms are computed like those of the train set
+    spec_batch_size = 1 if metadata['engine'] == 'librosa' else 8
+    for i, (file, (s, _)) in enumerate(zip(files, spectrograms(files, workers, cache_dir, spec_batch_size,
+                                                               metadata['resampler']))):
+        names.append(file)
+        spec.append(s.reshape(1, *s.shape))
+        if len(names) == batch_files or i == len(files) - 1:
+            spec = compress(np.concatenate(spec))
+            spec -= mean
+            spec /= std
+            yield names, chunk_tracks(spec, chunk_size, hop)
+            names = []
+            spec = []
+
+
+def predict(model, files, batch_files=64, batch_size=256, strategy='hard', workers=None, cache_dir=None, hop=None,
+            chunk_size=80):
+    """
+    Predict the genre of each file.
+
+    :param model: object, model of the CNN.
+    :param files: list, paths to the audio files.
+    :param batch_files: int, number of files whose chunks are predicted in one call. Default is 64.
+    :param batch_size: int, batch size of the model. Default is 256.
+    :param strategy: string, voting strategy of the chunk predictions, 'hard', 'soft' or 'log'. Default is 'hard'.
+    :param workers: int, number of worker processes computing the mel-spectrograms. Default is None, which uses all
+    the cores.
+    :param cache_dir: string, directory of the spectrogram cache. Default is None, which disables the cache.
+    :param hop: int, number of frames between the start of consecutive chunks, a smaller hop than the chunk size votes
+    on more, overlapping chunks. Default is None, which gives non-overlapping chunks.
+    :param chunk_size: int, number of frames per chunk the model was trained on. Default is 80.
+    :return: generator, yielding tuples of the file and its predicted label.
+    """
+    n_chunks = count_chunks(spec_len, chunk_size, hop)
+    for names, X in batches(files, batch_files, workers, cache_dir, hop, chunk_size):
+        prediction = model.predict(X, batch_size=batch_size)
+        for name, label in zip(names, vote(prediction, n_chunks, strategy)):
+            yield name, label
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Predict the genre of audio files.')
+    parser.add_argument('paths', nargs='+', help='audio files or directories containing audio files')
+    parser.add_argument('--channel', type=int, choices=[2, 3], default=3, help='number of channels of the CNN')
+    parser.add_argument('--fold', type=int, default=0, help='fold of the weights in ./models')
+    parser.add_argument('--weights', help='path to the weights, overrides --fold')
+    parser.add_argument('--gpus', type=int, default=2, help='number of GPUs the model was trained on')
+    parser.add_argument('--chunk-size', type=int, default=n_samples,
+                        help='frames per chunk the model was trained on with train.py --spec --chunk-size')
+    parser.add_argument('--vote', choices=['hard', 'soft', 'log'], default='hard',
+                        help='aggregation of the chunk predictions of each song, default is the majority vote')
+    parser.add_argument('--hop', type=int, default=None,
+                        help='frames between consecutive chunks, default is the chunk size, less votes on overlapping '
+                             'chunks')
+    parser.add_argument('--batch-files', type=int, default=64, help='number of files predicted in one call')
+    parser.add_argument('--batch-size', type=int, default=256, help='batch size of the model')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes, default is the number of cores, 1 runs serially')
+    parser.add_argument('--cache-dir', default=None, help='directory of the spectrogram cache, default is no cache')
+    args = parser.parse_args()
+    if args.hop is not None and args.hop < 1:
+        parser.error('--hop must be at least 1')
+
+    weights_path = args.weights or './models/cnn_weights_{}.h5'.format(args.fold)
+    model = load_cnn(args.channel, weights_path, gpu_count=args.gpus, chunk_size=args.chunk_size)
+    for name, label in predict(model, list_audio(args.paths), args.batch_files, args.batch_size, args.vote,
+                               args.workers, args.cache_dir, args.hop, args.chunk_size):
+        print('{}\t{}'.format(name, genres[label]))
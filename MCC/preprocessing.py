@@ -1,9 +1,28 @@
+import argparse
+import collections
+import functools
+import hashlib
+import inspect
+import json
+import math
+import multiprocessing
 import os
+import time
 
 import librosa
 import numpy as np
 import scipy.signal
 
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+try:
+    from scipy.fft import rfft
+except ImportError:  # scipy < 1.4
+    from numpy.fft import rfft
+
 label_encoder = {'blues': 0, 'classical': 1, 'country': 2, 'disco': 3, 'hiphop': 4, 'jazz': 5, 'metal': 6, 'pop': 7,
                  'reggae': 8, 'rock': 9}
 n_chunks = 16
@@ -13,60 +32,392 @@ sr = 44100
 hop_length = 1024
 au_duration = 30
 spec_len = int(np.rint(sr * au_duration / hop_length))
+# padding of the centered frames of librosa.stft, which changed across librosa versions
+stft_pad_mode = inspect.signature(librosa.stft).parameters['pad_mode'].default
+# Sun .au encodings read natively: data type and full scale
+au_encodings = {2: ('i1', 2 ** 7), 3: ('>i2', 2 ** 15), 5: ('>i4', 2 ** 31), 6: ('>f4', 1), 7: ('>f8', 1)}
+# seconds decoded after au_duration, so that the edge effects of the resampler fall outside the kept signal
+decode_margin = 1
+# version of the normalization statistics file, increased whenever its content changes
+stats_version = 3
 
 
-def chunk(input, chunk_size=80):
+def count_chunks(length, chunk_size=80, hop=None):
     """
-    Convert input data in chunks of chunk_size. Excess are discarded.
+    Number of chunks chunk() splits data of the given length into.
 
-    :param input: 2D array, data to be chunked.
+    :param length: int, length of the rows of the data.
     :param chunk_size: int, size of each chunk. Default is 80.
-    :return: 3D array, number of chunks x length of rows x chunk_size
+    :param hop: int, distance between the start of consecutive chunks. Default is None, which is chunk_size.
+    :return: int, number of chunks.
+    """
+    hop = chunk_size if hop is None else hop
+    return max(0, 1 + (length - chunk_size) // hop)
+
+
+def chunk(input, chunk_size=80, hop=None, out=None):
+    """
+    Convert input data in chunks of chunk_size, hop apart. Excess are discarded. The chunks are a strided view of the
+    input, so nothing is copied unless out is given.
+
+    :param input: array, data to be chunked, ... x rows x length of rows.
+    :param chunk_size: int, size of each chunk. Default is 80.
+    :param hop: int, distance between the start of consecutive chunks. Default is None, which is chunk_size, i.e.
+    non-overlapping chunks. A smaller hop gives overlapping chunks.
+    :param out: array, buffer the chunks are written to, with the shape of the chunks optionally followed by axes of
+    length 1. Default is None.
+    :return: array, ... x number of chunks x rows x chunk_size read-only view of the input, or out.
+    """
+    hop = chunk_size if hop is None else hop
+    shape = input.shape[:-2] + (count_chunks(input.shape[-1], chunk_size, hop), input.shape[-2], chunk_size)
+    strides = input.strides[:-2] + (hop * input.strides[-1], input.strides[-2], input.strides[-1])
+    chunks = np.lib.stride_tricks.as_strided(input, shape=shape, strides=strides, writeable=False)
+    if out is None:
+        return chunks
+    out[...] = chunks.reshape(chunks.shape + (1,) * (out.ndim - chunks.ndim))
+    return out
+
+
+def chunk_tracks(spec, chunk_size=80, hop=None, out=None):
+    """
+    Chunk the spectrograms of several tracks into the layout of the CNN input, the chunks of each track in consecutive
+    rows, in a single copy.
+
+    :param spec: 3D array, tracks x mels x frames.
+    :param chunk_size: int, size of each chunk. Default is 80.
+    :param hop: int, distance between the start of consecutive chunks. Default is None, which is chunk_size.
+    :param out: array, contiguous (tracks * number of chunks) x mels x chunk_size x 1 buffer the chunks are written to.
+    Default is None, which allocates it.
+    :return: 4D array, (tracks * number of chunks) x mels x chunk_size x 1 chunks.
+    """
+    chunks = chunk(spec, chunk_size, hop)
+    if out is None:
+        out = np.empty((chunks.shape[0] * chunks.shape[1],) + chunks.shape[2:] + (1,), dtype=spec.dtype)
+    chunk(spec, chunk_size, hop, out.reshape(chunks.shape + (1,)))
+    return out
+
+
+def compress(data, out=None):
+    """
+    Perform dynamic range compression of the data.
+
+    :param data: array, mel-spectrogram data.
+    :param out: array, float array the compressed data is written to, which may be data itself. Default is None,
+    which allocates it.
+    :return: array, compressed data.
+    """
+    if out is None:
+        return np.log10(10000 * data + 1)
+    np.multiply(data, 10000, out=out)
+    out += 1
+    return np.log10(out, out=out)
+
+
+class RunningStats(object):
+    """
+    Running mean and variance of a stream of arrays. The statistics of each array are merged with the parallel
+    algorithm of Chan et al., which stays numerically stable over a large number of updates.
+    """
+
+    def __init__(self, axis=None):
+        """
+        :param axis: int, axis whose entries have their own statistics, e.g. -2 for the mel bands of spectrograms.
+        Default is None, which computes the statistics of all the values.
+        """
+        self.axis = axis
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def update(self, data):
+        """
+        Add the values of an array to the statistics.
+
+        :param data: array, values to be added.
+        """
+        data = np.asarray(data, dtype=np.float64)
+        if data.size == 0:
+            return
+        if self.axis is None:
+            mean = np.mean(data)
+            self.merge(data.size, mean, np.sum(np.square(data - mean)))
+        else:
+            axes = tuple(i for i in range(data.ndim) if i != self.axis % data.ndim)
+            mean = np.mean(data, axis=axes, keepdims=True)
+            self.merge(data.size // mean.size, mean.ravel(), np.sum(np.square(data - mean), axis=axes))
+
+    def merge(self, count, mean, m2):
+        """
+        Merge the statistics of another set of values.
+
+        :param count: int, number of values.
+        :param mean: float, mean of the values.
+        :param m2: float, sum of the squared differences from the mean of the values.
+        """
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    @property
+    def std(self):
+        """
+        :return: float, population standard deviation of the values.
+        """
+        return np.sqrt(self.m2 / self.count)
+
+    def state(self):
+        """
+        :return: dict, count, mean and m2 of the statistics as JSON values.
+        """
+        return {'count': int(self.count), 'mean': np.asarray(self.mean).tolist(), 'm2': np.asarray(self.m2).tolist()}
+
+    def load_state(self, state):
+        """
+        Restore the statistics from the values returned by state().
+
+        :param state: dict, count, mean and m2 of the statistics.
+        """
+        self.count = state['count']
+        self.mean, self.m2 = (np.asarray(state[key]) if self.axis is not None else float(state[key])
+                              for key in ('mean', 'm2'))
+
+
+def spectrogram_params():
+    """
+    :return: dict, parameters of the spectrograms the normalization statistics depend on.
     """
-    output = []
-    for i in range(0, input.shape[1] // chunk_size * chunk_size, chunk_size):
-        output.append(input[:, i:i + chunk_size])
-    return np.array(output)
+    return {'sr': sr, 'win_length': 2048, 'hop_length': hop_length, 'window': 'blackmanharris', 'n_mels': n_mels,
+            'duration': au_duration, 'compression': 'log10(10000 * x + 1)'}
 
 
-def normalize(state, data, mean_path='./models/mean.npy', std_path='./models/std.npy'):
+def track_key(spec):
+    """
+    :param spec: array, mel-spectrogram of a track.
+    :return: string, hash of the mel-spectrogram, which identifies the track in the normalization statistics.
+    """
+    return hashlib.sha1(np.ascontiguousarray(spec)).hexdigest()
+
+
+def dataset_hash(keys):
+    """
+    :param keys: list, key of each track, see track_key().
+    :return: string, hash of the set of tracks, whatever their order.
+    """
+    return hashlib.sha1(''.join(sorted(keys)).encode()).hexdigest()
+
+
+def save_stats(stats, band_stats, keys, mode='global', stats_path='./models/norm_stats.npz', engine='librosa',
+               resampler='best'):
+    """
+    Write the normalization statistics of the train set atomically, with the normalization mode, the spectrogram
+    parameters, engine and resampler, the creation time, the keys of the tracks and a hash of the dataset derived from
+    them.
+
+    :param stats: RunningStats, statistics of all the values.
+    :param band_stats: RunningStats, statistics of each mel band.
+    :param keys: list, key of each track, see track_key().
+    :param mode: string, normalization mode the train set was standardized with, see norm_moments(). Default is
+    'global'.
+    :param stats_path: string, path to the statistics file. Default is './models/norm_stats.npz'.
+    :param engine: string, 'librosa' or 'batch', engine of the spectrograms, see cache_key(). Default is 'librosa'.
+    :param resampler: string, 'best' or 'fast', see resample(). Default is 'best'.
+    """
+    keys = sorted(keys)
+    metadata = {'version': stats_version, 'mode': mode, 'params': spectrogram_params(), 'engine': engine,
+                'resampler': resampler, 'dataset_hash': dataset_hash(keys), 'n_tracks': len(keys),
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'tracks': keys}
+    tmp_path = stats_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, count=stats.count, mean=stats.mean, m2=stats.m2, band_count=band_stats.count,
+                 band_mean=band_stats.mean, band_m2=band_stats.m2, metadata=json.dumps(metadata))
+    os.replace(tmp_path, stats_path)
+
+
+def load_stats(stats_path='./models/norm_stats.npz', engine=None, resampler=None):
+    """
+    Read the normalization statistics of the train set and check that they were computed by this version with the
+    current spectrogram parameters, that the dataset hash matches the recorded tracks and, when they are given, that the
+    train set was extracted with the same engine and resampler.
+
+    :param stats_path: string, path to the statistics file. Default is './models/norm_stats.npz'.
+    :param engine: string, 'librosa' or 'batch', engine the data to be standardized is computed with. Default is None,
+    which accepts either.
+    :param resampler: string, 'best' or 'fast', resampler the data to be standardized is computed with. Default is
+    None, which accepts either.
+    :return: tuple, RunningStats of all the values, RunningStats of each mel band and dict, metadata of the statistics.
+    """
+    if not os.path.exists(stats_path):
+        raise IOError('{} not found, extract the train set first'.format(stats_path))
+    with np.load(stats_path) as f:
+        metadata = json.loads(str(f['metadata']))
+        if metadata['version'] != stats_version:
+            raise ValueError('{} has version {}, expected {}, extract the train set again'.format(
+                stats_path, metadata['version'], stats_version))
+        if metadata['params'] != spectrogram_params():
+            raise ValueError('{} was computed with the spectrogram parameters {}, expected {}'.format(
+                stats_path, metadata['params'], spectrogram_params()))
+        tracks = metadata['tracks']
+        if metadata['n_tracks'] != len(tracks) or metadata['dataset_hash'] != dataset_hash(tracks):
+            raise ValueError('{} is corrupt, its dataset hash does not match its tracks'.format(stats_path))
+        for key, value in (('engine', engine), ('resampler', resampler)):
+            if value is not None and metadata[key] != value:
+                raise ValueError('{} was computed with the {} {}, expected {}, extract the train and test set with the '
+                                 'same options'.format(stats_path, key, metadata[key], value))
+        stats = RunningStats()
+        stats.count, stats.mean, stats.m2 = int(f['count']), float(f['mean']), float(f['m2'])
+        band_stats = RunningStats(axis=-2)
+        band_stats.count, band_stats.mean, band_stats.m2 = int(f['band_count']), f['band_mean'], f['band_m2']
+    return stats, band_stats, metadata
+
+
+def norm_moments(stats, band_stats, mode='global', band_axis=-2):
+    """
+    :param stats: RunningStats, statistics of all the values.
+    :param band_stats: RunningStats, statistics of each mel band.
+    :param mode: string, 'global' for a single mean and standard deviation, 'band' for one per mel band. Default is
+    'global'.
+    :param band_axis: int, axis of the mel bands in the data, -2 for spectrograms and -3 for chunks. Default is -2.
+    :return: tuple, mean and standard deviation the data is standardized with, scalars or arrays broadcasting along
+    the mel bands.
+    """
+    if mode == 'band':
+        shape = (-1,) + (1,) * (-band_axis - 1)
+        return band_stats.mean.reshape(shape), band_stats.std.reshape(shape)
+    return stats.mean, stats.std
+
+
+def normalize(state, data, stats_path='./models/norm_stats.npz', keys=(), mode='global'):
     """
     Perform dynamic range compression and standardization of the data.
-    If state is train, compute the mean and standard deviation of the data for standardization.
-    If state is test, retrieve the train's mean and standard deviation for standardization.
+    If state is train, compute the mean and standard deviation of the data for standardization and save them.
+    If state is test, retrieve the train's mean and standard deviation for standardization, with the mode of the train
+    set.
 
     :param state: string, 'train' or 'test'.
     :param data: 3D array, data to be normalized.
-    :param mean_path: path to mean file. Default is './models/mean.npy'.
-    :param std_path: path to standard deviation file. Default is './models/std.npy'.
+    :param stats_path: string, path to the statistics file, see save_stats(). Default is './models/norm_stats.npz'.
+    :param keys: list, key of each track of the train set, see track_key(). Default is (), which records no tracks.
+    :param mode: string, normalization mode of the train set, see norm_moments(). Default is 'global'.
     :return: 3D array, normalized data.
     """
-    data = np.log10(10000 * data + 1)
+    data = compress(data)
     if 'train' in state:
-        mean = np.mean(data)
-        std = np.std(data)
-        np.save(mean_path, mean)
-        np.save(std_path, std)
+        stats = RunningStats()
+        stats.update(data)
+        band_stats = RunningStats(axis=-2)
+        band_stats.update(data)
+        save_stats(stats, band_stats, keys, mode, stats_path)
     else:
-        mean = np.load(mean_path)
-        std = np.load(std_path)
-    data = (data - mean) / std
+        stats, band_stats, metadata = load_stats(stats_path)
+        mode = metadata['mode']
+    mean, std = norm_moments(stats, band_stats, mode)
+    data -= mean
+    data /= std
     return data
 
 
-def spectrogram(file, sr=44100, win_length=2048, hop_length=1024, window=scipy.signal.blackmanharris(2048), n_mels=40):
+def read_au_header(f):
     """
-    Compute the mel-spectrogram.
+    Read the header of a Sun .au file and move to the start of its data.
+
+    :param f: file, .au file opened in binary mode.
+    :return: tuple, data type, full scale, sampling rate and number of channels of the file. None if the file is not a
+    .au file or its encoding is not supported.
+    """
+    header = f.read(24)
+    if len(header) < 24 or header[:4] != b'.snd':
+        return None
+    offset, _, encoding, rate, channels = np.frombuffer(header[4:], dtype='>u4')
+    if encoding not in au_encodings:
+        return None
+    f.seek(offset)
+    return au_encodings[encoding] + (int(rate), int(channels))
+
+
+def read_au(file, duration=None):
+    """
+    Read the beginning of a Sun .au file without decoding the rest of it.
+
+    :param file: string, path to the file.
+    :param duration: float, number of seconds to read. Default is None, which reads the whole file.
+    :return: tuple, 2D array, channels x samples signal in [-1, 1), and its sampling rate. None if the file is not a
+    .au file or its encoding is not supported.
+    """
+    with open(file, 'rb') as f:
+        header = read_au_header(f)
+        if header is None:
+            return None
+        dtype, scale, rate, channels = header
+        count = -1 if duration is None else int(duration * rate) * channels
+        data = np.fromfile(f, dtype=dtype, count=count)
+    data = data[:len(data) - len(data) % channels].astype(np.float32) / scale
+    return data.reshape(-1, channels).T, rate
+
+
+def decode(file, duration=None):
+    """
+    Decode the beginning of an audio file at its native sampling rate. .au files are read directly, other formats with
+    soundfile if it is installed, and librosa otherwise.
+
+    :param file: string, path to the file.
+    :param duration: float, number of seconds to decode. Default is None, which decodes the whole file.
+    :return: tuple, 1D array, mono audio signal, and its sampling rate.
+    """
+    audio = read_au(file, duration) if file.lower().endswith('.au') else None
+    if audio is None and soundfile is not None:
+        try:
+            with soundfile.SoundFile(file) as f:
+                frames = -1 if duration is None else int(duration * f.samplerate)
+                audio = f.read(frames, dtype='float32', always_2d=True).T, f.samplerate
+        except RuntimeError:  # format not supported by libsndfile
+            pass
+    if audio is None:
+        return librosa.core.load(file, sr=None, duration=duration)
+    y, rate = audio
+    return np.mean(y, axis=0) if len(y) > 1 else y[0], rate
+
+
+def resample(y, orig_sr, target_sr, resampler='best'):
+    """
+    Resample a signal. Nothing is done if the rates are equal.
+
+    :param y: 1D array, audio signal.
+    :param orig_sr: int, sampling rate of the signal.
+    :param target_sr: int, target sampling rate.
+    :param resampler: string, 'best' for the high quality resampler of librosa.core.load or 'fast' for a polyphase
+    filter. Default is 'best'.
+    :return: 1D array, resampled signal.
+    """
+    if orig_sr == target_sr:
+        return y
+    if resampler == 'fast':
+        gcd = math.gcd(orig_sr, target_sr)
+        return scipy.signal.resample_poly(y, target_sr // gcd, orig_sr // gcd).astype(np.float32)
+    return librosa.resample(y, orig_sr=orig_sr, target_sr=target_sr)
+
+
+def load_audio(file, sr=44100, resampler='best', timings=None):
+    """
+    Load an audio file, truncated or zero-padded to au_duration seconds. Only the beginning of the file is decoded.
 
     :param file: string, path to the file.
     :param sr: int, sampling rate. Default is 44100.
-    :param win_length: int, window length. Default is 2048.
-    :param hop_length: int, hop length. Default is 1024.
-    :param window: scipy.signal, window used for the signal. Default is scipy.signal.blackmanharris(2048).
-    :param n_mels: int, number of mels. Default is 40.
-    :return: 2D array, mel-spectrogram
+    :param resampler: string, 'best' or 'fast', see resample(). Default is 'best'.
+    :param timings: Counter, to which the decoding and resampling times in seconds are added. Default is None.
+    :return: 1D array, audio signal.
     """
-    y, sr = librosa.core.load(file, sr=sr)
+    start = time.time()
+    y, native_sr = decode(file, au_duration + decode_margin)
+    decoded = time.time()
+    y = resample(y, native_sr, sr, resampler)
+    if timings is not None:
+        timings['decode_time'] += decoded - start
+        timings['resample_time'] += time.time() - decoded
 
     length = sr * au_duration
 
@@ -75,52 +426,808 @@ def spectrogram(file, sr=44100, win_length=2048, hop_length=1024, window=scipy.s
     elif len(y) < length:
         zeros = np.zeros(length - len(y))
         y = np.append(y, zeros)
+    return y
+
+
+def spectrogram(file, sr=44100, win_length=2048, hop_length=1024, window='blackmanharris', n_mels=40,
+                resampler='best'):
+    """
+    Compute the mel-spectrogram.
+
+    :param file: string, path to the file.
+    :param sr: int, sampling rate. Default is 44100.
+    :param win_length: int, window length. Default is 2048.
+    :param hop_length: int, hop length. Default is 1024.
+    :param window: string, tuple or 1D array, window used for the signal, see get_window(). Default is 'blackmanharris'.
+    :param n_mels: int, number of mels. Default is 40.
+    :param resampler: string, 'best' or 'fast', see resample(). Default is 'best'.
+    :return: 2D array, mel-spectrogram
+    """
+    return melspectrogram(load_audio(file, sr, resampler), sr, win_length, hop_length, window, n_mels)
+
+
+def melspectrogram(y, sr=44100, win_length=2048, hop_length=1024, window='blackmanharris', n_mels=40):
+    """
+    Compute the mel-spectrogram of a signal. Same as librosa.feature.melspectrogram, but with the cached window and
+    mel filterbank instead of building them on every call.
 
+    :param y: 1D array, audio signal.
+    :param sr: int, sampling rate. Default is 44100.
+    :param win_length: int, window length. Default is 2048.
+    :param hop_length: int, hop length. Default is 1024.
+    :param window: string, tuple or 1D array, window used for the signal, see get_window(). Default is 'blackmanharris'.
+    :param n_mels: int, number of mels. Default is 40.
+    :return: 2D array, mel-spectrogram
+    """
+    window = get_window(window, win_length)
     spec = np.abs(librosa.stft(y=y, hop_length=hop_length, window=window, win_length=win_length)) ** 2
-    melspec = librosa.feature.melspectrogram(sr=sr, S=spec, hop_length=hop_length, n_mels=n_mels)
+    melspec = np.einsum('...ft,mf->...mt', spec, mel_basis(sr, win_length, n_mels), optimize=True)
     return melspec
 
 
-def extract(path, save_X, save_y):
+@functools.lru_cache(maxsize=8)
+def mel_basis(sr, n_fft, n_mels, fmin=0.0, fmax=None):
     """
-    Extract and store the chunked melspectrogram of the audio files contained in the path. Only files that end with
-    '.au' are processed.
+    Compute the mel filterbank. The filterbank is cached, so it is only built once per set of parameters.
+
+    :param sr: int, sampling rate.
+    :param n_fft: int, length of the FFT.
+    :param n_mels: int, number of mels.
+    :param fmin: float, lowest frequency in Hz. Default is 0.
+    :param fmax: float, highest frequency in Hz. Default is None, which uses sr / 2.
+    :return: 2D array, read-only n_mels x (1 + n_fft / 2) filterbank.
+    """
+    basis = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax)
+    basis.flags.writeable = False
+    return basis
+
+
+def get_window(window, win_length):
+    """
+    Get a window by name. Arrays are returned as they are, names are built once per length and cached.
+
+    :param window: string, tuple or 1D array, name of the window and its parameters, as in scipy.signal.get_window,
+    or the window itself.
+    :param win_length: int, window length.
+    :return: 1D array, read-only window.
+    """
+    if isinstance(window, (str, tuple)):
+        return cached_window(window, win_length)
+    return window
+
+
+@functools.lru_cache(maxsize=8)
+def cached_window(window, win_length):
+    """
+    Build a symmetric window, e.g. 'blackmanharris' is the same as scipy.signal.blackmanharris(win_length).
+
+    :param window: string or tuple, name of the window and its parameters.
+    :param win_length: int, window length.
+    :return: 1D array, read-only window.
+    """
+    window = scipy.signal.get_window(window, win_length, fftbins=False)
+    window.flags.writeable = False
+    return window
+
+
+def frame(signals, frame_length=2048, hop_length=1024):
+    """
+    Split signals into overlapping frames without copying them.
+
+    :param signals: 2D array, signals x samples.
+    :param frame_length: int, number of samples per frame. Default is 2048.
+    :param hop_length: int, number of samples between the start of consecutive frames. Default is 1024.
+    :return: 3D array, read-only view of the signals, signals x frames x frame_length.
+    """
+    n_frames = 1 + (signals.shape[1] - frame_length) // hop_length
+    return np.lib.stride_tricks.as_strided(signals, shape=(signals.shape[0], n_frames, frame_length),
+                                           strides=(signals.strides[0], hop_length * signals.strides[1],
+                                                    signals.strides[1]), writeable=False)
+
+
+def batch_spectrogram(signals, sr=44100, win_length=2048, hop_length=1024, window='blackmanharris', n_mels=40,
+                      block_frames=128):
+    """
+    Compute the mel-spectrograms of a batch of signals of equal length at once. The signals are framed with a strided
+    view, and each block of block_frames frames is windowed, transformed with a real FFT and projected on the cached
+    mel filterbank with a matrix product. The temporaries of a block stay in the CPU cache, while those of whole tracks
+    are tens of megabytes and make the computation memory-bound. The computation runs in single precision, like
+    librosa, and matches spectrogram() up to floating point precision.
+
+    :param signals: 2D array, signals x samples, e.g. stacked outputs of load_audio().
+    :param sr: int, sampling rate. Default is 44100.
+    :param win_length: int, window length. Default is 2048.
+    :param hop_length: int, hop length. Default is 1024.
+    :param window: string, tuple or 1D array, window used for the signal, see get_window(). Default is 'blackmanharris'.
+    :param n_mels: int, number of mels. Default is 40.
+    :param block_frames: int, number of frames transformed at a time. Default is 128.
+    :return: 3D array, signals x n_mels x frames mel-spectrograms.
+    """
+    signals = np.asarray(signals, dtype=np.float32)
+    # centered frames, padded like librosa.stft
+    padded = np.pad(signals, ((0, 0), (win_length // 2, win_length // 2)), mode=stft_pad_mode)
+    window = np.asarray(get_window(window, win_length), dtype=np.float32)
+    basis = mel_basis(sr, win_length, n_mels).T
+    frames = frame(padded, win_length, hop_length)
+    melspec = np.empty((len(signals), frames.shape[1], n_mels), dtype=np.float32)
+    for i in range(len(signals)):
+        for start in range(0, frames.shape[1], block_frames):
+            stft = rfft(frames[i, start:start + block_frames] * window, axis=1)
+            np.matmul(stft.real ** 2 + stft.imag ** 2, basis, out=melspec[i, start:start + block_frames])
+    return np.ascontiguousarray(melspec.transpose(0, 2, 1))
+
+
+def read_blocks(file, block_duration=10.):
+    """
+    Read an audio file of any length block by block at its native sampling rate. .au files are read directly and other
+    formats with soundfile if it is installed, one block at a time. Otherwise the file is decoded at once by librosa
+    and split into blocks.
+
+    :param file: string, path to the file.
+    :param block_duration: float, number of seconds per block. Default is 10.
+    :return: generator, yielding tuples of a 1D array, consecutive block of the mono signal, and its sampling rate.
+    """
+    if file.lower().endswith('.au'):
+        with open(file, 'rb') as f:
+            header = read_au_header(f)
+            if header is not None:
+                dtype, scale, rate, channels = header
+                while True:
+                    data = np.fromfile(f, dtype=dtype, count=int(block_duration * rate) * channels)
+                    if len(data) < channels:
+                        return
+                    data = data[:len(data) - len(data) % channels].astype(np.float32) / scale
+                    yield np.mean(data.reshape(-1, channels), axis=1), rate
+    if soundfile is not None:
+        try:
+            f = soundfile.SoundFile(file)
+        except RuntimeError:  # format not supported by libsndfile
+            f = None
+        if f is not None:
+            with f:
+                for data in f.blocks(int(block_duration * f.samplerate), dtype='float32', always_2d=True):
+                    yield np.mean(data, axis=1), f.samplerate
+            return
+    y, rate = librosa.core.load(file, sr=None)
+    for i in range(0, len(y), int(block_duration * rate)):
+        yield y[i:i + int(block_duration * rate)], rate
+
+
+def stream_resample(blocks, sr=44100, resampler='best', margin=0.05):
+    """
+    Resample a stream of blocks. Each block is resampled together with margin seconds of the neighbouring blocks,
+    which are then discarded, so the samples at the edges of the blocks are filtered like the rest of the signal. The
+    blocks are cut at multiples of the resampling period, so the kept samples line up exactly.
+
+    :param blocks: iterable, tuples of a 1D array, block of the signal, and its sampling rate, see read_blocks().
+    :param sr: int, target sampling rate. Default is 44100.
+    :param resampler: string, 'best' or 'fast', see resample(). Default is 'best'.
+    :param margin: float, number of seconds of context on each side of a block. Default is 0.05.
+    :return: generator, yielding 1D arrays, consecutive blocks of the signal at the target sampling rate.
+    """
+    buffer = None
+    for block, rate in blocks:
+        if rate == sr:
+            yield block
+            continue
+        if buffer is None:
+            gcd = math.gcd(rate, sr)
+            up, down = sr // gcd, rate // gcd
+            pad = down * int(math.ceil(margin * rate / down))
+            buffer = np.zeros(pad, dtype=np.float32)
+        buffer = np.concatenate([buffer, block])
+        n = (len(buffer) - 2 * pad) // down * down
+        if n > 0:
+            y = resample(buffer[:n + 2 * pad], rate, sr, resampler)
+            yield y[pad // down * up:(pad + n) // down * up]
+            buffer = buffer[n:]
+    if buffer is not None and len(buffer) > pad:
+        n = len(buffer) - pad
+        y = resample(np.concatenate([buffer, np.zeros(pad, dtype=np.float32)]), rate, sr, resampler)
+        yield y[pad // down * up:pad // down * up + int(math.ceil(n * up / down))]
+
+
+def stream_melspectrogram(blocks, sr=44100, win_length=2048, hop_length=1024, window='blackmanharris', n_mels=40):
+    """
+    Compute the mel-spectrogram of a signal arriving in blocks, with the engine of batch_spectrogram(). The start of the
+    signal is padded like librosa.stft and the samples of the frames spanning two blocks are carried over to the next
+    block, so the frames are those of the whole signal. The end is not padded, the last frames are the ones that fit.
+
+    :param blocks: iterable, 1D arrays, consecutive blocks of the signal.
+    :param sr: int, sampling rate. Default is 44100.
+    :param win_length: int, window length. Default is 2048.
+    :param hop_length: int, hop length. Default is 1024.
+    :param window: string, tuple or 1D array, window used for the signal, see get_window(). Default is 'blackmanharris'.
+    :param n_mels: int, number of mels. Default is 40.
+    :return: generator, yielding 2D arrays, n_mels x frames mel-spectrograms of the frames completed by each block.
+    """
+    window = np.asarray(get_window(window, win_length), dtype=np.float32)
+    basis = mel_basis(sr, win_length, n_mels)
+    buffer = np.zeros(0, dtype=np.float32)
+    padded = False
+    for block in blocks:
+        buffer = np.concatenate([buffer, np.asarray(block, dtype=np.float32)])
+        if not padded:
+            # reflection needs more samples than the padding
+            if len(buffer) <= win_length // 2:
+                continue
+            buffer = np.pad(buffer, (win_length // 2, 0), mode=stft_pad_mode)
+            padded = True
+        n_frames = count_chunks(len(buffer), win_length, hop_length)
+        if n_frames:
+            stft = rfft(frame(buffer[np.newaxis], win_length, hop_length)[0] * window, axis=1)
+            yield np.matmul(basis, (stft.real ** 2 + stft.imag ** 2).T)
+            buffer = buffer[n_frames * hop_length:]
+
+
+def stream_chunks(file, chunk_size=80, hop=None, block_duration=10., resampler=None,
+                  stats_path='./models/norm_stats.npz'):
+    """
+    Read an audio file of any length block by block and yield its normalized chunks as soon as they are complete. Only
+    the current block and the frames of an incomplete chunk are held in memory, whatever the length of the file.
+
+    :param file: string, path to the file.
+    :param chunk_size: int, size of each chunk. Default is 80.
+    :param hop: int, distance between the start of consecutive chunks, from 1 to chunk_size, as the frames skipped by a
+    larger hop would be lost across blocks. Default is None, which is chunk_size.
+    :param block_duration: float, number of seconds read at a time. Default is 10.
+    :param resampler: string, 'best' or 'fast', see resample(). Default is None, which is the resampler of the train
+    set.
+    :param stats_path: string, path to the normalization statistics of the train set, see save_stats(), which must
+    have been extracted with the engine of batch_spectrogram(). Default is './models/norm_stats.npz'.
+    :return: generator, yielding tuples of the index of the first frame of the chunk and the chunk, n_mels x
+    chunk_size x 1.
+    """
+    # the frames are those of batch_spectrogram(), standardized with the statistics of a train set extracted alike
+    norm_stats, band_norm_stats, metadata = load_stats(stats_path, 'batch', resampler)
+    mean, std = norm_moments(norm_stats, band_norm_stats, metadata['mode'])
+    resampler = metadata['resampler'] if resampler is None else resampler
+    hop = chunk_size if hop is None else hop
+    if not 0 < hop <= chunk_size:
+        raise ValueError('hop must be between 1 and the chunk size {}, got {}'.format(chunk_size, hop))
+    frames = np.zeros((n_mels, 0), dtype=np.float32)
+    start = 0
+    for melspec in stream_melspectrogram(stream_resample(read_blocks(file, block_duration), sr, resampler)):
+        compress(melspec, out=melspec)
+        melspec -= mean
+        melspec /= std
+        frames = np.concatenate([frames, melspec], axis=1)
+        n = count_chunks(frames.shape[1], chunk_size, hop)
+        for i, c in enumerate(chunk(frames, chunk_size, hop)):
+            yield start + i * hop, c[..., np.newaxis]
+        frames = frames[:, n * hop:]
+        start += n * hop
+
+
+def cache_key(file, sr=44100, win_length=2048, hop_length=1024, window='blackmanharris', n_mels=40, engine='librosa',
+              resampler='best'):
+    """
+    Compute the cache key of the mel-spectrogram of a file. The key is the hash of the content of the file and of the
+    parameters of the mel-spectrogram, so a renamed file still hits the cache and a changed file or parameter misses.
+
+    :param file: string, path to the file.
+    :param sr: int, sampling rate. Default is 44100.
+    :param win_length: int, window length. Default is 2048.
+    :param hop_length: int, hop length. Default is 1024.
+    :param window: string, tuple or 1D array, window used for the signal, see get_window(). Default is 'blackmanharris'.
+    :param n_mels: int, number of mels. Default is 40.
+    :param engine: string, 'librosa' for spectrogram() or 'batch' for batch_spectrogram(). Default is 'librosa'.
+    :param resampler: string, 'best' or 'fast', see resample(). Default is 'best'.
+    :return: string, hexadecimal digest.
+    """
+    h = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    h.update(repr((sr, win_length, hop_length, n_mels, au_duration, engine, resampler)).encode())
+    h.update(np.ascontiguousarray(get_window(window, win_length)).tobytes())
+    return h.hexdigest()
+
+
+def cached_spectrograms(files, cache_dir=None, batched=False, resampler='best'):
+    """
+    Compute the mel-spectrograms of a group of files, reusing those stored in cache_dir for the files that were already
+    processed.
+
+    :param files: list, paths to the files.
+    :param cache_dir: string, directory of the cache. Default is None, which disables the cache.
+    :param batched: bool, whether to compute the missing spectrograms together with batch_spectrogram() instead of one
+    by one with spectrogram(). Default is False.
+    :param resampler: string, 'best' or 'fast', see resample(). Default is 'best'.
+    :return: list, tuples of the mel-spectrogram and the statistics of each file: cache hits, misses, read and written
+    bytes, and decoding, resampling and spectrogram times in seconds.
+    """
+    engine = 'batch' if batched else 'librosa'
+    results = []
+    missing = []
+    for i, file in enumerate(files):
+        stats = collections.Counter()
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, cache_key(file, engine=engine, resampler=resampler) + '.npy')
+        if cache_path is not None and os.path.exists(cache_path):
+            stats['hits'] += 1
+            stats['read_bytes'] += os.path.getsize(cache_path)
+            results.append((np.load(cache_path), stats))
+        else:
+            results.append((cache_path, stats))
+            missing.append(i)
+
+    signals = [load_audio(files[i], resampler=resampler, timings=results[i][1]) for i in missing]
+    start = time.time()
+    if batched and missing:
+        specs = batch_spectrogram(np.stack(signals))
+    else:
+        specs = [melspectrogram(y) for y in signals]
+    for i in missing:
+        results[i][1]['spectrogram_time'] += (time.time() - start) / len(missing)
+
+    for i, s in zip(missing, specs):
+        cache_path, stats = results[i]
+        results[i] = (s, stats)
+        if cache_path is None:
+            continue
+        # write to a temporary file first so that concurrent workers never read a partial entry
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, s)
+        os.replace(tmp_path, cache_path)
+        stats['misses'] += 1
+        stats['written_bytes'] += os.path.getsize(cache_path)
+    return results
+
+
+def list_files(path):
+    """
+    List the audio files contained in the path in a deterministic order. Only files that end with '.au' are listed.
 
     :param path: string, path containing the audio files.
-    :param save_X: string, path to save the training or test data.
-    :param save_y: string, path to save the labels.
+    :return: list, tuples of file path and label.
     """
-    spec = []
-    labels = []
+    items = []
     for root, dirs, files in os.walk(path):
+        dirs.sort()
         for file in sorted(files):
             if file.endswith('.au'):
-                filepath = root + '/' + file
-                print(filepath)
                 label = (file.split('.'))[0]
+                items.append((root + '/' + file, label_encoder[label]))
+    return items
+
+
+def spectrograms(files, workers=None, cache_dir=None, batch_size=1, resampler='best'):
+    """
+    Compute the mel-spectrograms of the files with a pool of worker processes. The results are yielded in the same
+    order as the files, so the output does not depend on the number of workers. At most two groups of batch_size files
+    per worker are submitted ahead of the consumer, so a slow consumer holds at most 2 * workers * batch_size
+    spectrograms besides the ones it was given, whatever the number of files.
+
+    :param files: list, paths to the files.
+    :param workers: int, number of worker processes. Default is None, which uses all the cores. 1 runs serially.
+    :param cache_dir: string, directory of the spectrogram cache. Default is None, which disables the cache.
+    :param batch_size: int, number of files whose spectrograms are computed together by batch_spectrogram(). Default
+    is 1, which computes every spectrogram on its own with spectrogram().
+    :param resampler: string, 'best' or 'fast', see resample(). Default is 'best'.
+    :return: generator, mel-spectrogram and statistics of each file.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    compute = functools.partial(cached_spectrograms, cache_dir=cache_dir, batched=batch_size > 1, resampler=resampler)
+    groups = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    if workers <= 1:
+        for group in groups:
+            for result in compute(group):
+                yield result
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            # submit a window of groups instead of all of them, so the results waiting for the consumer are bounded
+            pending = collections.deque()
+            for group in groups:
+                pending.append(pool.apply_async(compute, (group,)))
+                if len(pending) < 2 * workers:
+                    continue
+                for result in pending.popleft().get():
+                    yield result
+            while pending:
+                for result in pending.popleft().get():
+                    yield result
+
+
+def print_cache_stats(stats):
+    """
+    Print the statistics of the spectrogram cache.
+
+    :param stats: Counter, containing the hits, misses, read and written bytes of the cache.
+    """
+    print("Cache: {} hits, {} misses, {:.1f} MB read, {:.1f} MB written".format(
+        stats['hits'], stats['misses'], stats['read_bytes'] / 2 ** 20, stats['written_bytes'] / 2 ** 20))
+
+
+def print_timings(stats):
+    """
+    Print the time spent in each stage of the spectrogram computation, summed over the worker processes.
 
-                s = spectrogram(filepath)
+    :param stats: Counter, containing the decoding, resampling and spectrogram times in seconds.
+    """
+    print("Time: {:.1f} s decoding, {:.1f} s resampling, {:.1f} s spectrogram".format(
+        stats['decode_time'], stats['resample_time'], stats['spectrogram_time']))
 
-                spec.append(s.reshape(1, *s.shape))
-                labels.append(label_encoder[label])
 
-    spec = np.concatenate(spec)
-    spec = normalize(path, spec)
+def quantize(X, axis):
+    """
+    Quantize data to 256 levels per band, so that X ~= q * scale + offset.
 
-    X = []
-    y = []
-    for i in range(len(spec)):
-        c = chunk(spec[i, :, :])
-        X.append(c.reshape(*c.shape, 1))
-        y.extend([labels[i] for j in range(n_chunks)])
+    :param X: array, data to be quantized.
+    :param axis: int, axis of the bands.
+    :return: tuple, uint8 array, quantized data; float32 arrays, scale and offset of each band, broadcastable to X.
+    """
+    axes = tuple(a for a in range(X.ndim) if a != axis % X.ndim)
+    offset = X.min(axis=axes, keepdims=True)
+    scale = (X.max(axis=axes, keepdims=True) - offset) / 255
+    scale[scale == 0] = 1
+    q = np.clip(np.rint((X - offset) / scale), 0, 255).astype(np.uint8)
+    return q, scale.astype(np.float32), offset.astype(np.float32)
 
-    X = np.concatenate(X)
-    y = np.asarray(y)
 
+def save_data(save_X, X, dtype='float64', band_axis=-3):
+    """
+    Save the data in the given data type. uint8 quantizes each band and saves the scale and offset in
+    <save_X>_quant.npz, next to the data.
+
+    :param save_X: string, path to save the data.
+    :param X: array, data to be saved.
+    :param dtype: string, 'float64', 'float32', 'float16' or 'uint8'. Default is 'float64'.
+    :param band_axis: int, axis of the bands of the data. Default is -3, the mel axis of the chunks.
+    """
+    quant_path = os.path.splitext(save_X)[0] + '_quant.npz'
+    if dtype == 'uint8':
+        X, scale, offset = quantize(X, band_axis)
+        np.savez(quant_path, scale=scale, offset=offset)
+    else:
+        X = X.astype(dtype, copy=False)
+        if os.path.exists(quant_path):
+            os.remove(quant_path)
     np.save(save_X, X)
+
+
+def extract(path, save_X, save_y, workers=None, cache_dir=None, batch_size=1, resampler='best', full=False,
+            dtype='float64', mode='global', stats_path='./models/norm_stats.npz'):
+    """
+    Extract and store the chunked melspectrogram of the audio files contained in the path. Only files that end with
+    '.au' are processed. Each track is compressed in place as it arrives and, for the train set, added to the
+    normalization statistics, so the corpus is standardized in place once all the tracks are in.
+
+    :param path: string, path containing the audio files.
+    :param save_X: string, path to save the training or test data.
+    :param save_y: string, path to save the labels.
+    :param workers: int, number of worker processes computing the mel-spectrograms. Default is None, which uses all
+    the cores.
+    :param cache_dir: string, directory of the spectrogram cache. Default is None, which disables the cache.
+    :param batch_size: int, number of files whose spectrograms are computed together. Default is 1.
+    :param resampler: string, 'best' or 'fast', see resample(). Default is 'best'.
+    :param full: bool, whether to store the full normalized melspectrograms, tracks x n_mels x spec_len, with one
+    label per track, instead of the chunks, so chunks are sliced at training time. Default is False.
+    :param dtype: string, data type the data is stored in, see save_data(). Default is 'float64'.
+    :param mode: string, normalization mode of the train set, see norm_moments(). The test set uses the mode of the
+    train set. Default is 'global'.
+    :param stats_path: string, path to the statistics file, see save_stats(). Default is './models/norm_stats.npz'.
+    """
+    items = list_files(path)
+    train = 'train' in path
+    engine = 'batch' if batch_size > 1 else 'librosa'
+    if not train:
+        running, band_running, metadata = load_stats(stats_path, engine, resampler)
+        mode = metadata['mode']
+
+    specs = spectrograms([filepath for filepath, _ in items], workers, cache_dir, batch_size, resampler)
+    spec = np.empty((len(items), n_mels, spec_len))
+    labels = []
+    keys = []
+    if train:
+        running = RunningStats()
+        band_running = RunningStats(axis=-2)
+    cache_stats = collections.Counter()
+    for i, ((filepath, label), (s, stats)) in enumerate(zip(items, specs)):
+        print(filepath)
+        spec[i] = s
+        labels.append(label)
+        keys.append(track_key(s))
+        compress(spec[i], out=spec[i])
+        if train:
+            running.update(spec[i])
+            band_running.update(spec[i])
+        cache_stats.update(stats)
+
+    if train:
+        save_stats(running, band_running, keys, mode, stats_path, engine, resampler)
+    mean, std = norm_moments(running, band_running, mode)
+    spec -= mean
+    spec /= std
+
+    if full:
+        X = spec
+        y = np.asarray(labels)
+    else:
+        X = chunk_tracks(spec)
+        y = np.repeat(labels, n_chunks)
+
+    save_data(save_X, X, dtype, band_axis=-2 if full else -3)
     np.save(save_y, y)
 
+    if cache_dir is not None:
+        print_cache_stats(cache_stats)
+    print_timings(cache_stats)
+
+
+def extract_streaming(path, save_X, save_y, workers=None, cache_dir=None, batch_size=1, resampler='best', full=False,
+                      mode='global', stats_path='./models/norm_stats.npz'):
+    """
+    Extract and store the chunked melspectrogram of the audio files contained in the path like extract(), without
+    holding the whole corpus in memory. The first pass writes the compressed chunks to a preallocated memory-mapped
+    output and accumulates the mean and variance; the second pass standardizes the output one track at a time. The
+    test set is standardized in the first pass with the train's mean and standard deviation.
+
+    :param path: string, path containing the audio files.
+    :param save_X: string, path to save the training or test data.
+    :param save_y: string, path to save the labels.
+    :param workers: int, number of worker processes computing the mel-spectrograms. Default is None, which uses all
+    the cores.
+    :param cache_dir: string, directory of the spectrogram cache. Default is None, which disables the cache.
+    :param batch_size: int, number of files whose spectrograms are computed together. Default is 1.
+    :param resampler: string, 'best' or 'fast', see resample(). Default is 'best'.
+    :param full: bool, whether to store the full normalized melspectrograms instead of the chunks, see extract().
+    Default is False.
+    :param mode: string, normalization mode of the train set, see norm_moments(). The test set uses the mode of the
+    train set. Default is 'global'.
+    :param stats_path: string, path to the statistics file, see save_stats(). Default is './models/norm_stats.npz'.
+    """
+    items = list_files(path)
+    train = 'train' in path
+    engine = 'batch' if batch_size > 1 else 'librosa'
+    if not train:
+        norm_stats, band_norm_stats, metadata = load_stats(stats_path, engine, resampler)
+        mean, std = norm_moments(norm_stats, band_norm_stats, metadata['mode'])
+
+    specs = spectrograms([filepath for filepath, _ in items], workers, cache_dir, batch_size, resampler)
+    shape = (len(items), n_mels, spec_len) if full else (len(items) * n_chunks, n_mels, n_samples, 1)
+    X = np.lib.format.open_memmap(save_X, mode='w+', dtype=np.float64, shape=shape)
+    labels = []
+    keys = []
+    running = RunningStats()
+    band_running = RunningStats(axis=-2)
+    cache_stats = collections.Counter()
+    for i, ((filepath, label), (s, stats)) in enumerate(zip(items, specs)):
+        print(filepath)
+        keys.append(track_key(s))
+        # in double precision, like the in-memory extraction
+        s = compress(s.astype(np.float64))
+        if train:
+            running.update(s)
+            band_running.update(s)
+        else:
+            s -= mean
+            s /= std
+        if full:
+            X[i] = s
+        else:
+            chunk(s, out=X[i * n_chunks:(i + 1) * n_chunks])
+        labels.append(label)
+        cache_stats.update(stats)
+
+    if train:
+        save_stats(running, band_running, keys, mode, stats_path, engine, resampler)
+        mean, std = norm_moments(running, band_running, mode, band_axis=-2 if full else -3)
+        for i in range(len(items)):
+            track = X[i] if full else X[i * n_chunks:(i + 1) * n_chunks]
+            track -= mean
+            track /= std
+    X.flush()
+    del X
+
+    np.save(save_y, np.asarray(labels) if full else np.repeat(labels, n_chunks))
+
+    if cache_dir is not None:
+        print_cache_stats(cache_stats)
+    print_timings(cache_stats)
+
+
+def load_index(save_dir):
+    """
+    Read the index of a sharded output.
+
+    :param save_dir: string, directory of the shards.
+    :return: dict, index of the shards, or None if the directory has no index.
+    """
+    path = os.path.join(save_dir, 'index.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_index(save_dir, index):
+    """
+    Write the index of a sharded output atomically, so readers never see a partial index.
+
+    :param save_dir: string, directory of the shards.
+    :param index: dict, index of the shards.
+    """
+    tmp_path = os.path.join(save_dir, 'index.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(save_dir, 'index.json'))
+
+
+def save_shard(save_dir, shard_index, X):
+    """
+    Write a shard atomically.
+
+    :param save_dir: string, directory of the shards.
+    :param shard_index: int, index of the shard.
+    :param X: array, samples of the shard.
+    :return: string, file name of the shard.
+    """
+    name = 'shard_{:05d}.npy'.format(shard_index)
+    tmp_path = os.path.join(save_dir, name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, X)
+    os.replace(tmp_path, os.path.join(save_dir, name))
+    return name
+
+
+def extract_sharded(path, save_dir, workers=None, cache_dir=None, batch_size=1, resampler='best', shard_size=64,
+                    mode='global', stats_path='./models/norm_stats.npz'):
+    """
+    Extract and store the chunked melspectrogram of the audio files contained in the path like extract(), as a
+    directory of shards of shard_size tracks each plus an index.json listing the shards, with their offset and
+    length in samples, and the file, label, track id, key, shard and offset of every track. Every shard is standardized
+    and written atomically, then added to the index, as soon as it is full, so a training run started before the end
+    trains on the shards completed at its start. The test set is standardized with the train's mean and standard
+    deviation; each train shard with those of the tracks extracted so far, which the index records with the shard.
+    Once the train set is complete, the index records the mean and standard deviation of the whole set, which readers
+    correct every shard to.
+
+    An index left by an interrupted extraction of the same files, spectrogram parameters, engine, resampler and mode is
+    resumed: its shards are kept and the running statistics recorded with it are restored, so only the remaining
+    tracks are extracted. Otherwise the shards in the directory are removed.
+
+    :param path: string, path containing the audio files.
+    :param save_dir: string, directory of the shards.
+    :param workers: int, number of worker processes computing the mel-spectrograms. Default is None, which uses all
+    the cores.
+    :param cache_dir: string, directory of the spectrogram cache. Default is None, which disables the cache.
+    :param batch_size: int, number of files whose spectrograms are computed together. Default is 1.
+    :param resampler: string, 'best' or 'fast', see resample(). Default is 'best'.
+    :param shard_size: int, number of tracks per shard. Default is 64.
+    :param mode: string, normalization mode of the train set, see norm_moments(). The test set uses the mode of the
+    train set. Default is 'global'.
+    :param stats_path: string, path to the statistics file, see save_stats(). Default is './models/norm_stats.npz'.
+    """
+    items = list_files(path)
+    files = [filepath for filepath, _ in items]
+    train = 'train' in path
+    engine = 'batch' if batch_size > 1 else 'librosa'
+    if not train:
+        norm_stats, band_norm_stats, metadata = load_stats(stats_path, engine, resampler)
+        mode = metadata['mode']
+        mean, std = norm_moments(norm_stats, band_norm_stats, mode, band_axis=-3)
+
+    os.makedirs(save_dir, exist_ok=True)
+    shape = [n_mels, n_samples, 1]
+    index = load_index(save_dir)
+    if (index is None or index.get('version') != 3 or index['shape'] != shape or index['mode'] != mode
+            or index['params'] != spectrogram_params() or index['engine'] != engine or index['resampler'] != resampler
+            or [track['file'] for track in index['tracks']] != files[:len(index['tracks'])]):
+        for name in os.listdir(save_dir):
+            if name.startswith('shard_') or name.endswith('.tmp'):
+                os.remove(os.path.join(save_dir, name))
+        index = {'version': 3, 'shape': shape, 'dtype': 'float64', 'samples_per_track': n_chunks,
+                 'params': spectrogram_params(), 'engine': engine, 'resampler': resampler, 'mode': mode, 'mean': None,
+                 'std': None, 'running': None, 'length': 0, 'shards': [], 'tracks': []}
+        save_index(save_dir, index)
+    done = len(index['tracks'])
+    if done:
+        print('Resuming {} after {} tracks'.format(save_dir, done))
+
+    running = RunningStats()
+    band_running = RunningStats(axis=-2)
+    if index['running'] is not None:
+        running.load_state(index['running']['stats'])
+        band_running.load_state(index['running']['band_stats'])
+    keys = [track['key'] for track in index['tracks']]
+    specs = spectrograms(files[done:], workers, cache_dir, batch_size, resampler)
+    shard = np.empty((shard_size * n_chunks, n_mels, n_samples, 1))
+    n_tracks = 0
+    cache_stats = collections.Counter()
+    for i, ((filepath, label), (s, stats)) in enumerate(zip(items[done:], specs), done):
+        print(filepath)
+        keys.append(track_key(s))
+        # in double precision, like the in-memory extraction
+        s = compress(s.astype(np.float64))
+        if train:
+            running.update(s)
+            band_running.update(s)
+        index['tracks'].append({'file': filepath, 'label': int(label),
+                                'track_id': os.path.splitext(os.path.basename(filepath))[0], 'key': keys[-1],
+                                'shard': len(index['shards']), 'offset': n_tracks * n_chunks})
+        chunk(s, out=shard[n_tracks * n_chunks:(n_tracks + 1) * n_chunks])
+        n_tracks += 1
+        cache_stats.update(stats)
+
+        if n_tracks == shard_size or i == len(items) - 1:
+            if train:
+                mean, std = norm_moments(running, band_running, mode, band_axis=-3)
+            X = shard[:n_tracks * n_chunks]
+            X -= mean
+            X /= std
+            name = save_shard(save_dir, len(index['shards']), X)
+            index['shards'].append({'file': name, 'offset': index['length'], 'length': len(X), 'normalized': True,
+                                    'mean': np.ravel(mean).tolist(), 'std': np.ravel(std).tolist()})
+            index['length'] += len(X)
+            index['running'] = {'stats': running.state(), 'band_stats': band_running.state()}
+            save_index(save_dir, index)
+            n_tracks = 0
+
+    if train:
+        save_stats(running, band_running, keys, mode, stats_path, engine, resampler)
+        mean, std = norm_moments(running, band_running, mode, band_axis=-3)
+    index['mean'], index['std'] = np.ravel(mean).tolist(), np.ravel(std).tolist()
+    save_index(save_dir, index)
+
+    if cache_dir is not None:
+        print_cache_stats(cache_stats)
+    print_timings(cache_stats)
+
 
 if __name__ == '__main__':
-    extract(path='../../train', save_X='./models/train_X.npy', save_y='./models/train_y.npy')
-    extract(path='../../test', save_X='./models/test_X.npy', save_y='./models/test_y.npy')
+    parser = argparse.ArgumentParser(description='Extract the mel-spectrograms of the train and test set.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes, default is the number of cores, 1 runs serially')
+    parser.add_argument('--cache-dir', default='./models/cache', help='directory of the spectrogram cache')
+    parser.add_argument('--no-cache', action='store_true', help='recompute every spectrogram without the cache')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='number of tracks whose spectrograms are computed together with a vectorized STFT, '
+                             'default is 1, which uses librosa on every track')
+    parser.add_argument('--resampler', choices=['best', 'fast'], default='best',
+                        help='resampler of the tracks whose sampling rate is not 44.1 kHz, default is the high '
+                             'quality resampler of librosa, fast is a polyphase filter')
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('--streaming', action='store_true',
+                        help='normalize in two passes over a memory-mapped output instead of in memory')
+    output.add_argument('--shards', action='store_true',
+                        help='write ./models/train_shards and ./models/test_shards, shards of --shard-size tracks '
+                             'with an index, instead of single .npy files')
+    parser.add_argument('--shard-size', type=int, default=64, help='number of tracks per shard')
+    parser.add_argument('--full', action='store_true',
+                        help='store the full spectrograms in ./models/train_spec.npy and ./models/test_spec.npy '
+                             'instead of the chunks, for train.py --spec')
+    parser.add_argument('--dtype', choices=['float64', 'float32', 'float16', 'uint8'], default='float64',
+                        help='data type the data is stored in, uint8 quantizes each mel band with a stored scale and '
+                             'offset, not supported with --streaming and --shards')
+    parser.add_argument('--norm', choices=['global', 'band'], default='global',
+                        help='standardization of the train set, one mean and std for all the values or one per mel '
+                             'band, the test set and predict.py follow the train set')
+    parser.add_argument('--skip-train', action='store_true',
+                        help='extract only the test set, normalized with the statistics of the train set stored in '
+                             './models/norm_stats.npz by a previous run')
+    args = parser.parse_args()
+    cache_dir = None if args.no_cache else args.cache_dir
+    if args.dtype != 'float64' and (args.streaming or args.shards):
+        parser.error('--dtype is only supported by the in-memory extraction')
+    if args.full and args.shards:
+        parser.error('--full is not supported with --shards, which stores the chunks')
+
+    names = ['test'] if args.skip_train else ['train', 'test']
+    if args.shards:
+        for name in names:
+            extract_sharded('../../{}'.format(name), './models/{}_shards'.format(name), args.workers, cache_dir,
+                            args.batch_size, args.resampler, args.shard_size, args.norm)
+    else:
+        run = extract_streaming if args.streaming else functools.partial(extract, dtype=args.dtype)
+        X_name, y_name = ('spec', 'spec_y') if args.full else ('X', 'y')
+
+        for name in names:
+            run(path='../../{}'.format(name), save_X='./models/{}_{}.npy'.format(name, X_name),
+                save_y='./models/{}_{}.npy'.format(name, y_name), workers=args.workers, cache_dir=cache_dir,
+                batch_size=args.batch_size, resampler=args.resampler, full=args.full, mode=args.norm)
@@ -0,0 +1,253 @@
+import argparse
+import collections
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import tensorflow as tf
+
+try:
+    from audioread import DecodeError
+except ImportError:
+    DecodeError = RuntimeError
+
+from predict import genres
+from preprocessing import cached_spectrograms, chunk_tracks, compress, count_chunks, load_stats, n_samples, \
+    norm_moments, spec_len
+from train import load_cnn, vote
+
+
+class Batcher(object):
+    """
+    Coalesce the chunks of concurrent requests into micro-batches of at most max_batch chunks. A single thread owns the
+    model and predicts a batch as soon as the next request would not fit or the oldest request has waited max_wait
+    seconds. A request of more than max_batch chunks is split across consecutive batches.
+    """
+
+    def __init__(self, model, max_batch=256, max_wait=0.005, window=10000):
+        """
+        :param model: object, model of the CNN.
+        :param max_batch: int, maximum number of chunks per batch. Default is 256.
+        :param max_wait: float, maximum time in seconds a request waits for other requests. Default is 0.005.
+        :param window: int, number of most recent requests the latency percentiles are computed on. Default is 10000.
+        """
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.Counter()
+        self.n_requests = 0
+
+        # the predict function must be built before it is called from another thread
+        self.model._make_predict_function()
+        self.graph = tf.get_default_graph()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def predict(self, X):
+        """
+        Predict the chunks of one request. Blocks until the batches containing them are predicted.
+
+        :param X: 4D array, chunks of the request.
+        :return: 2D array, probability of the prediction of each chunk.
+        """
+        futures = []
+        for i in range(0, len(X), self.max_batch):
+            future = Future()
+            self.queue.put((X[i:i + self.max_batch], future))
+            futures.append(future)
+        return np.concatenate([future.result() for future in futures])
+
+    def run(self):
+        """
+        Collect and predict the micro-batches.
+        """
+        pending = None
+        while True:
+            items = [pending if pending is not None else self.queue.get()]
+            pending = None
+            size = len(items[0][0])
+            deadline = time.time() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if size + len(item[0]) > self.max_batch:
+                    # the request starts the next batch
+                    pending = item
+                    break
+                items.append(item)
+                size += len(item[0])
+
+            try:
+                with self.graph.as_default():
+                    prediction = self.model.predict(np.concatenate([X for X, _ in items]), batch_size=size)
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+
+            with self.lock:
+                self.batch_sizes[1 << (size - 1).bit_length()] += 1
+            offset = 0
+            for X, future in items:
+                future.set_result(prediction[offset:offset + len(X)])
+                offset += len(X)
+
+    def record(self, latency):
+        """
+        Record the latency of a request.
+
+        :param latency: float, latency in seconds.
+        """
+        with self.lock:
+            self.latencies.append(latency)
+            self.n_requests += 1
+
+    def stats(self):
+        """
+        :return: dict, number of requests, latency percentiles in milliseconds and histogram of the batch sizes, in
+        buckets of powers of two.
+        """
+        with self.lock:
+            latencies = np.asarray(self.latencies) * 1000
+            batch_sizes = sorted(self.batch_sizes.items())
+            n_requests = self.n_requests
+        percentiles = {}
+        if len(latencies):
+            for p in (50, 90, 99):
+                percentiles['p{}'.format(p)] = float(np.percentile(latencies, p))
+        return {'requests': n_requests, 'latency_ms': percentiles,
+                'batch_sizes': collections.OrderedDict(('<={}'.format(k), v) for k, v in batch_sizes)}
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    POST /predict with {"files": [paths]} returns the genre of each file. GET /stats returns the batching statistics.
+    The mean and standard deviation of the train set are loaded once, before serving, and the spectrograms are
+    computed with the engine and resampler of the train set.
+    """
+    batcher = None
+    moments = None
+    engine = 'librosa'
+    resampler = 'best'
+    strategy = 'hard'
+    chunk_size = n_samples
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        self.reply(self.batcher.stats())
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_error(404)
+            return
+        start = time.time()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+            files = request['files'] if 'files' in request else [request['file']]
+            spec = compress(np.stack([s for s, _ in cached_spectrograms(files, batched=self.engine == 'batch',
+                                                                        resampler=self.resampler)]))
+        except (ValueError, KeyError, TypeError) as e:  # malformed JSON, missing Content-Length or file
+            self.send_error(400, str(e))
+            return
+        except (RuntimeError, DecodeError, EOFError, IOError) as e:  # missing file or one the decoders cannot read
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        mean, std = self.moments
+        spec -= mean
+        spec /= std
+        X = chunk_tracks(spec, self.chunk_size)
+        try:
+            prediction = self.batcher.predict(X)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        labels = vote(prediction, count_chunks(spec_len, self.chunk_size), self.strategy)
+        self.reply({'predictions': [{'file': file, 'genre': genres[label]} for file, label in zip(files, labels)]})
+        self.batcher.record(time.time() - start)
+
+    def reply(self, content):
+        body = json.dumps(content).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UnixServer(Server):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = self.server_address
+        self.server_port = 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve genre predictions over HTTP.')
+    parser.add_argument('--channel', type=int, choices=[2, 3], default=3, help='number of channels of the CNN')
+    parser.add_argument('--fold', type=int, default=0, help='fold of the weights in ./models')
+    parser.add_argument('--weights', help='path to the weights, overrides --fold')
+    parser.add_argument('--gpus', type=int, default=2, help='number of GPUs the model was trained on')
+    parser.add_argument('--chunk-size', type=int, default=n_samples,
+                        help='frames per chunk the model was trained on with train.py --spec --chunk-size')
+    parser.add_argument('--vote', choices=['hard', 'soft', 'log'], default='hard',
+                        help='aggregation of the chunk predictions of each song, default is the majority vote')
+    parser.add_argument('--max-batch', type=int, default=256, help='maximum number of chunks per batch')
+    parser.add_argument('--max-wait', type=float, default=5, help='maximum time in ms a request waits for a batch')
+    parser.add_argument('--host', default='127.0.0.1', help='host to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--socket', help='path of a Unix socket to listen on instead of the host and port')
+    parser.add_argument('--stats', default='./models/norm_stats.npz',
+                        help='normalization statistics of the train set written by preprocessing.py')
+    args = parser.parse_args()
+
+    try:
+        stats, band_stats, metadata = load_stats(args.stats)
+    except (ValueError, IOError) as e:
+        parser.error(str(e))
+    Handler.moments = norm_moments(stats, band_stats, metadata['mode'])
+    Handler.engine = metadata['engine']
+    Handler.resampler = metadata['resampler']
+
+    weights_path = args.weights or './models/cnn_weights_{}.h5'.format(args.fold)
+    Handler.batcher = Batcher(load_cnn(args.channel, weights_path, gpu_count=args.gpus, chunk_size=args.chunk_size),
+                              args.max_batch, args.max_wait / 1000)
+    Handler.strategy = args.vote
+    Handler.chunk_size = args.chunk_size
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixServer(args.socket, Handler)
+    else:
+        server = Server((args.host, args.port), Handler)
+    print('Serving on {}'.format(args.socket or '{}:{}'.format(args.host, args.port)))
+    server.serve_forever()
@@ -0,0 +1,119 @@
+import argparse
+import collections
+import time
+
+import numpy as np
+
+from predict import genres
+from preprocessing import hop_length, n_samples, sr, stream_chunks
+from train import load_cnn, vote
+
+
+def timeline(model, file, window=16, strategy='hard', batch_chunks=16, hop=None, block_duration=10., resampler=None,
+             chunk_size=80):
+    """
+    Classify an audio file of any length, e.g. a DJ set or a radio recording, with a sliding window. The chunks are
+    predicted in batches as they come out of the stream, and the predictions of the last window chunks are voted into
+    the genre at the end of each chunk. Memory stays bounded whatever the length of the file.
+
+    :param model: object, model of the CNN.
+    :param file: string, path to the audio file.
+    :param window: int, number of most recent chunks the genre is voted on. Default is 16, about 30 seconds.
+    :param strategy: string, voting strategy of the chunk predictions, 'hard', 'soft' or 'log'. Default is 'hard'.
+    :param batch_chunks: int, number of chunks predicted in one call. Default is 16.
+    :param hop: int, number of frames between the start of consecutive chunks, at most chunk_size. Default is None,
+    which gives non-overlapping chunks.
+    :param block_duration: float, number of seconds of audio read at a time. Default is 10.
+    :param resampler: string, 'best' or 'fast', see preprocessing.resample(). Default is None, which is the resampler
+    of the train set.
+    :param chunk_size: int, number of frames per chunk the model was trained on. Default is 80.
+    :return: generator, yielding tuples of the time in seconds of the end of the chunk, the label voted on the window
+    and the mean probability of each genre over the window.
+    """
+    recent = collections.deque(maxlen=window)
+
+    def predict(starts, X):
+        prediction = model.predict(np.stack(X), batch_size=len(X))
+        for start, probability in zip(starts, prediction):
+            recent.append(probability)
+            probabilities = np.stack(recent)
+            yield ((start + chunk_size) * hop_length / sr, vote(probabilities, len(probabilities), strategy)[0],
+                   np.mean(probabilities, axis=0))
+
+    starts = []
+    X = []
+    for start, c in stream_chunks(file, chunk_size, hop, block_duration, resampler):
+        starts.append(start)
+        X.append(c)
+        if len(X) == batch_chunks:
+            yield from predict(starts, X)
+            starts = []
+            X = []
+    if X:
+        yield from predict(starts, X)
+
+
+def segments(points):
+    """
+    Merge the consecutive points of a timeline with the same genre.
+
+    :param points: iterable, tuples of the time in seconds, the label and the probabilities, see timeline().
+    :return: generator, yielding tuples of the start and end time in seconds of each segment and its label.
+    """
+    start = 0.
+    end = None
+    current = None
+    for end_time, label, _ in points:
+        if current is not None and label != current:
+            yield start, end, current
+            start = end
+        current = label
+        end = end_time
+    if current is not None:
+        yield start, end, current
+
+
+def format_time(seconds):
+    """
+    :param seconds: float, time in seconds.
+    :return: string, time as hours:minutes:seconds.
+    """
+    return time.strftime('%H:%M:%S', time.gmtime(seconds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the genre timeline of a long audio file.')
+    parser.add_argument('file', help='audio file of any length')
+    parser.add_argument('--channel', type=int, choices=[2, 3], default=3, help='number of channels of the CNN')
+    parser.add_argument('--fold', type=int, default=0, help='fold of the weights in ./models')
+    parser.add_argument('--weights', help='path to the weights, overrides --fold')
+    parser.add_argument('--gpus', type=int, default=2, help='number of GPUs the model was trained on')
+    parser.add_argument('--chunk-size', type=int, default=n_samples,
+                        help='frames per chunk the model was trained on with train.py --spec --chunk-size')
+    parser.add_argument('--window', type=int, default=16, help='number of most recent chunks the genre is voted on')
+    parser.add_argument('--vote', choices=['hard', 'soft', 'log'], default='hard',
+                        help='aggregation of the chunk predictions of the window, default is the majority vote')
+    parser.add_argument('--hop', type=int, default=None,
+                        help='frames between consecutive chunks, default is the chunk size, less gives overlapping '
+                             'chunks')
+    parser.add_argument('--batch-chunks', type=int, default=16, help='number of chunks predicted in one call')
+    parser.add_argument('--block-duration', type=float, default=10., help='seconds of audio read at a time')
+    parser.add_argument('--resampler', choices=['best', 'fast'], default=None,
+                        help='resampler of the files whose sampling rate is not 44.1 kHz, default is the one of the '
+                             'train set')
+    parser.add_argument('--segments', action='store_true',
+                        help='print the segments of consecutive chunks with the same genre instead of every chunk')
+    args = parser.parse_args()
+    if args.hop is not None and not 0 < args.hop <= args.chunk_size:
+        parser.error('--hop must be between 1 and {}'.format(args.chunk_size))
+
+    weights_path = args.weights or './models/cnn_weights_{}.h5'.format(args.fold)
+    model = load_cnn(args.channel, weights_path, gpu_count=args.gpus, chunk_size=args.chunk_size)
+    points = timeline(model, args.file, args.window, args.vote, args.batch_chunks, args.hop, args.block_duration,
+                      args.resampler, args.chunk_size)
+    if args.segments:
+        for start, end, label in segments(points):
+            print('{}\t{}\t{}'.format(format_time(start), format_time(end), genres[label]))
+    else:
+        for end, label, probabilities in points:
+            print('{}\t{}\t{:.2f}'.format(format_time(end), genres[label], probabilities[label]))
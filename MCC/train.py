@@ -1,14 +1,22 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
+import queue
 import sys
+import threading
+import time
 
 import matplotlib.pyplot as plt
 import numpy as np
+import tensorflow as tf
+from keras import backend as K
 from keras import optimizers, Input, Model
-from keras.callbacks import ModelCheckpoint, ReduceLROnPlateau, EarlyStopping
+from keras.callbacks import Callback, ModelCheckpoint, ReduceLROnPlateau, EarlyStopping
 from keras.initializers import TruncatedNormal
 from keras.layers import Dense, Conv2D, MaxPooling2D, Flatten, Concatenate, Dropout, BatchNormalization, Reshape
 from keras.utils import plot_model, to_categorical
-from scipy import stats
 from sklearn.metrics import confusion_matrix
 from sklearn.model_selection import KFold
 
@@ -16,16 +24,26 @@ from keras_tf_multigpu.kuza55 import make_parallel
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
+manifest_path = './models/run_manifest.json'
+splits_path = './models/run_splits.npz'
+fold_state_path = './models/run_fold_{}.json'
+fold_weights_path = './models/run_fold_{}_last.h5'
+fold_optimizer_path = './models/run_fold_{}_optimizer.npz'
+storage_report_path = './models/storage_report.csv'
+head_weights_path = './models/head_weights_{}.h5'
+head_model_path = './models/cnn_weights_{}_head.h5'
+features_path = './models/features/{}_{}.npy'
+
 
 def plot_history(history):
     """
     Plot the accuracy and loss graph of the CNN and save in './plots'.
 
-    :param history: object, containing the history of CNN.
+    :param history: dict, containing the history of CNN.
     """
     # summarize history for accuracy
-    plt.plot(history.history['acc'])
-    plt.plot(history.history['val_acc'])
+    plt.plot(history['acc'])
+    plt.plot(history['val_acc'])
     plt.title('model accuracy')
     plt.ylabel('accuracy')
     plt.xlabel('epoch')
@@ -35,8 +53,8 @@ def plot_history(history):
     plt.clf()
 
     # summarize history for loss
-    plt.plot(history.history['loss'])
-    plt.plot(history.history['val_loss'])
+    plt.plot(history['loss'])
+    plt.plot(history['val_loss'])
     plt.title('model loss')
     plt.ylabel('loss')
     plt.xlabel('epoch')
@@ -46,33 +64,114 @@ def plot_history(history):
     plt.clf()
 
 
-def callbacks():
+def callbacks(fold_index, weights_path='./models/cnn_weights_{}.h5'):
     """
     Callbacks used in CNN.
 
+    :param fold_index: int, index of the fold.
+    :param weights_path: string, path of the best weights, formatted with the fold index. Default is
+    './models/cnn_weights_{}.h5'.
     :return: list, containing the callbacks.
     """
-    checkpoint = ModelCheckpoint(filepath='./models/cnn_weights_{}.h5'.format(fold_index), monitor='val_acc',
+    checkpoint = ModelCheckpoint(filepath=weights_path.format(fold_index), monitor='val_acc',
                                  verbose=0, save_best_only=True, save_weights_only=True, mode='auto', period=1)
     reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=40, verbose=1, min_lr=0.0001)
     early_stopping = EarlyStopping(monitor='val_acc', min_delta=0.01, patience=200)
     return [checkpoint, reduce_lr, early_stopping]
 
 
-def cnn(channel=3):
+class FoldState(Callback):
+    """
+    Persist the state of a fold at the end of every epoch: the last weights, the optimizer weights and learning rate,
+    the state of the other callbacks and the history. When an interrupted fold is trained again, the state is restored
+    at the beginning of the training, after the other callbacks have reset themselves.
+    """
+
+    def __init__(self, fold_index, fold_callbacks, state=None):
+        """
+        :param fold_index: int, index of the fold.
+        :param fold_callbacks: list, checkpoint, reduce_lr and early_stopping callbacks as returned by callbacks().
+        :param state: dict, state of the fold as returned by load_fold_state(). Default is None, for a new fold.
+        """
+        super(FoldState, self).__init__()
+        self.fold_index = fold_index
+        self.checkpoint, self.reduce_lr, self.early_stopping = fold_callbacks
+        self.state = state if state is not None else {'status': 'running', 'epoch': 0, 'history': {}}
+
+    @property
+    def history(self):
+        return self.state['history']
+
+    def on_train_begin(self, logs=None):
+        if not self.state['epoch']:
+            return
+        self.model.load_weights(fold_weights_path.format(self.fold_index))
+        optimizer_weights = np.load(fold_optimizer_path.format(self.fold_index))
+        self.model.optimizer.set_weights([optimizer_weights['arr_{}'.format(i)]
+                                          for i in range(len(optimizer_weights.files))])
+        K.set_value(self.model.optimizer.lr, self.state['lr'])
+        self.checkpoint.best = self.state['checkpoint_best']
+        self.reduce_lr.best = self.state['reduce_lr_best']
+        self.reduce_lr.wait = self.state['reduce_lr_wait']
+        self.reduce_lr.cooldown_counter = self.state['reduce_lr_cooldown']
+        self.early_stopping.best = self.state['early_stopping_best']
+        self.early_stopping.wait = self.state['early_stopping_wait']
+
+    def on_epoch_end(self, epoch, logs=None):
+        for key, value in (logs or {}).items():
+            self.history.setdefault(key, []).append(float(value))
+
+        # weights, optimizer state, then fold state, each written to a temporary file first, so a run killed in the
+        # middle of a write never leaves a partial file
+        tmp_path = fold_weights_path.format(self.fold_index) + '.tmp'
+        self.model.save_weights(tmp_path, overwrite=True)
+        os.replace(tmp_path, fold_weights_path.format(self.fold_index))
+        tmp_path = fold_optimizer_path.format(self.fold_index) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, *self.model.optimizer.get_weights())
+        os.replace(tmp_path, fold_optimizer_path.format(self.fold_index))
+
+        self.state.update(epoch=epoch + 1, lr=float(K.get_value(self.model.optimizer.lr)),
+                          checkpoint_best=float(self.checkpoint.best), reduce_lr_best=float(self.reduce_lr.best),
+                          reduce_lr_wait=int(self.reduce_lr.wait),
+                          reduce_lr_cooldown=int(self.reduce_lr.cooldown_counter),
+                          early_stopping_best=float(self.early_stopping.best),
+                          early_stopping_wait=int(self.early_stopping.wait))
+        save_json(fold_state_path.format(self.fold_index), self.state)
+
+    def on_train_end(self, logs=None):
+        self.state['status'] = 'trained'
+        save_json(fold_state_path.format(self.fold_index), self.state)
+
+    def finish(self, accuracy, cm):
+        """
+        Mark the fold as done with its evaluation, so a resumed run skips it.
+
+        :param accuracy: float, test accuracy of the fold.
+        :param cm: 2D array, confusion matrix of the fold.
+        """
+        self.state.update(status='done', accuracy=float(accuracy), cm=np.asarray(cm).tolist())
+        save_json(fold_state_path.format(self.fold_index), self.state)
+
+
+def cnn(channel=3, gpu_count=2, plot=True, chunk_size=80):
     """
     Architecture and model of the CNN.
 
+    :param channel: int, number of channels of the CNN, 2 or 3. Default is 3.
+    :param gpu_count: int, number of GPUs the model is replicated on. Default is 2.
+    :param plot: bool, whether to plot the model in './plots'. Default is True.
+    :param chunk_size: int, number of frames per chunk, at least 60. Default is 80.
     :return: object, model of the CNN.
     """
     sgd = optimizers.SGD(lr=0.01, momentum=0.0, decay=0.0, nesterov=True)
-    inputs = Input(shape=(40, 80, 1))
+    inputs = Input(shape=(40, chunk_size, 1))
     gaussian = TruncatedNormal(stddev=0.01, seed=None)
 
     pitch = Conv2D(filters=32, kernel_size=(32, 1), kernel_initializer=gaussian, activation='relu', name='conv_1')(
         inputs)
     pitch = BatchNormalization()(pitch)
-    pitch = MaxPooling2D(pool_size=(1, 80))(pitch)
+    pitch = MaxPooling2D(pool_size=(1, chunk_size))(pitch)
     pitch = Reshape((1, 9, -1))(pitch)
 
     tempo = Conv2D(filters=32, kernel_size=(1, 60), kernel_initializer=gaussian, activation='relu', name='conv_2')(
@@ -84,7 +183,7 @@ def cnn(channel=3):
         inputs)
     bass = BatchNormalization()(bass)
     bass = MaxPooling2D(pool_size=(4, 4))(bass)
-    bass = Reshape((1, 126, -1))(bass)
+    bass = Reshape((1, -1, 32))(bass)
 
     if channel == 2:
         concatenate = Concatenate(axis=2)([pitch, tempo])
@@ -99,40 +198,192 @@ def cnn(channel=3):
     predictions = Dense(10, kernel_initializer=gaussian, activation='softmax', name='dense_2')(dropout)
 
     model = Model(inputs=inputs, outputs=predictions)
-    model = make_parallel(model, gpu_count=2)
+    model = make_parallel(model, gpu_count=gpu_count)
     model.compile(optimizer=sgd, loss='categorical_crossentropy', metrics=['accuracy'])
 
-    plot_model(model, to_file='./plots/model_plot.png', show_shapes=True, show_layer_names=True)
+    if plot:
+        plot_model(model, to_file='./plots/model_plot.png', show_shapes=True, show_layer_names=True)
+
+    return model
+
 
+def base_model(model):
+    """
+    Retrieve the single-device model replicated by make_parallel.
+
+    :param model: object, model returned by cnn().
+    :return: object, the replicated model, or the model itself if it is not replicated.
+    """
+    for layer in model.layers:
+        if isinstance(layer, Model):
+            return layer
     return model
 
 
-def convert_to_cm_labels(test_y, prediction):
+def load_cnn(channel, weights_path, gpu_count=2, chunk_size=80):
+    """
+    Load a trained CNN for inference. The weights are loaded into the same architecture they were trained with, then
+    the single-device model is returned, so inference does not need the GPUs used for training.
+
+    :param channel: int, number of channels of the CNN, 2 or 3.
+    :param weights_path: string, path to the weights, e.g. './models/cnn_weights_0.h5'.
+    :param gpu_count: int, number of GPUs the model was trained on. Default is 2.
+    :param chunk_size: int, number of frames per chunk the model was trained on. Default is 80.
+    :return: object, single-device model of the CNN.
+    """
+    model = cnn(channel, gpu_count=gpu_count, plot=False, chunk_size=chunk_size)
+    model.load_weights(weights_path)
+    return base_model(model)
+
+
+def front_end_index(model):
+    """
+    :param model: object, single-device model of the CNN.
+    :return: int, index in model.layers of the Flatten layer, which ends the conv front end, the pitch, tempo and bass
+    towers, and starts the head.
+    """
+    for i, layer in enumerate(model.layers):
+        if isinstance(layer, Flatten):
+            return i
+    raise ValueError('The model has no flattened features')
+
+
+def frozen_cnn(channel, frozen_path, gpu_count=2, chunk_size=80):
+    """
+    Build a new CNN whose conv front end is copied from the weights of a trained model, for training its head alone on
+    the features of the front end. The head is built from the layers of the new CNN, so once it is trained, the new
+    CNN is a whole model that load_cnn() loads like any other.
+
+    :param channel: int, number of channels of the CNN, 2 or 3.
+    :param frozen_path: string, path to the weights of the front end, e.g. './models/cnn_weights_0.h5'.
+    :param gpu_count: int, number of GPUs the model was trained on. Default is 2.
+    :param chunk_size: int, number of frames per chunk the model was trained on. Default is 80.
+    :return: tuple, model of the new CNN, model of its front end, from the input to the flattened features, and
+    compiled model of its head, from the flattened features to the probabilities.
+    """
+    model = cnn(channel, gpu_count=gpu_count, plot=False, chunk_size=chunk_size)
+    base = base_model(model)
+    donor = load_cnn(channel, frozen_path, gpu_count, chunk_size)
+    end = front_end_index(base)
+    for layer, donor_layer in zip(base.layers[:end], donor.layers[:end]):
+        layer.set_weights(donor_layer.get_weights())
+    front_end = Model(inputs=base.input, outputs=base.layers[end].output)
+
+    inputs = Input(shape=K.int_shape(front_end.output)[1:])
+    x = inputs
+    for layer in base.layers[end + 1:]:
+        x = layer(x)
+    head = Model(inputs=inputs, outputs=x)
+    sgd = optimizers.SGD(lr=0.01, momentum=0.0, decay=0.0, nesterov=True)
+    head.compile(optimizer=sgd, loss='categorical_crossentropy', metrics=['accuracy'])
+    return model, front_end, head
+
+
+def extract_features(front_end, X, path, batch_size=256):
+    """
+    Compute the features of the front end for all the samples, batch by batch, into a memory-mapped store, written
+    under a temporary name and renamed once complete. An existing store is reused.
+
+    :param front_end: object, model of the front end, see frozen_cnn().
+    :param X: array, data, possibly memory-mapped or sliced lazily.
+    :param path: string, path to the store.
+    :param batch_size: int, number of samples computed at a time. Default is 256.
+    :return: array, memory-mapped features, samples x feature size.
+    """
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                             shape=(len(X),) + K.int_shape(front_end.output)[1:])
+        for start in range(0, len(X), batch_size):
+            features[start:start + batch_size] = front_end.predict(X[start:start + batch_size], batch_size=batch_size)
+        features.flush()
+        del features
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
+
+
+def feature_store(front_end, options, train_X, test_X):
+    """
+    Compute or reuse the features of the front end for the train and test data. The stores are named after a hash of
+    the weights of the front end, of the layout of the data and of the size and modification time of its files, so
+    every fold and every later run training a head on the same front end and data reads them instead of running the
+    conv towers, while data written again by preprocessing.py gets new stores.
+
+    :param front_end: object, model of the front end, see frozen_cnn().
+    :param options: object, options returned by check_options().
+    :param train_X: array, train data.
+    :param test_X: array, test data.
+    :return: tuple, memory-mapped train and test features.
+    """
+    files = [(path, os.path.getsize(path), os.path.getmtime(path)) for path in data_paths(options)]
+    digest = hashlib.sha1(str((data_storage(options), files, train_X.shape, test_X.shape)).encode())
+    for weights in front_end.get_weights():
+        digest.update(np.ascontiguousarray(weights))
+    key = digest.hexdigest()
+    return (extract_features(front_end, train_X, features_path.format(key, 'train')),
+            extract_features(front_end, test_X, features_path.format(key, 'test')))
+
+
+def mode(labels, n_classes=10):
+    """
+    Compute the most frequent label of each row. Ties are broken in favour of the lowest label, like scipy.stats.mode.
+
+    :param labels: 2D array, containing integer labels, rows x labels.
+    :param n_classes: int, number of classes. Default is 10.
+    :return: 1D array, most frequent label of each row.
+    """
+    n_rows = labels.shape[0]
+    offsets = np.arange(n_rows)[:, np.newaxis] * n_classes
+    counts = np.bincount((labels + offsets).ravel(), minlength=n_rows * n_classes).reshape(n_rows, n_classes)
+    return np.argmax(counts, axis=1)
+
+
+def vote(prediction, n_chunks=16, strategy='hard'):
+    """
+    Aggregate the predictions of the chunks of each song into the label of the song.
+
+    :param prediction: 2D array, containing the probability of the prediction, with the n_chunks chunks of each song
+    in consecutive rows.
+    :param n_chunks: int, number of chunks per song. Default is 16.
+    :param strategy: string, 'hard' for the majority of the chunk labels, 'soft' for the highest mean probability or
+    'log' for the highest sum of log-probabilities. Default is 'hard'.
+    :return: 1D array, predicted label of each song.
+    """
+    prediction = prediction.reshape(-1, n_chunks, prediction.shape[-1])
+    if strategy == 'hard':
+        return mode(np.argmax(prediction, axis=2), n_classes=prediction.shape[-1])
+    elif strategy == 'soft':
+        return np.argmax(np.mean(prediction, axis=1), axis=1)
+    elif strategy == 'log':
+        return np.argmax(np.sum(np.log(np.maximum(prediction, np.finfo(prediction.dtype).tiny)), axis=1), axis=1)
+    else:
+        raise ValueError('Unknown voting strategy: {}'.format(strategy))
+
+
+def convert_to_cm_labels(test_y, prediction, strategy='hard', n_chunks=16):
     """
     Convert the ground truths and the predicted labels
 
     :param test_y: 1D array, containing the labels of the test data.
     :param prediction: 2D array, containing the probability of the prediction.
+    :param strategy: string, voting strategy of the predicted labels, 'hard', 'soft' or 'log'. Default is 'hard'.
+    :param n_chunks: int, number of chunks per song. Default is 16.
     :return: 1D arrays, predicted labels and ground truth labels.
     """
-    n_chunks = 16
-    predicted_labels = np.zeros((prediction.shape[0] // n_chunks))
-    ground_truth_labels = np.zeros((len(test_y) // n_chunks))
-    instance = 0
-    for i in range(0, len(test_y), n_chunks):
-        predicted = np.argmax(prediction[i:i + n_chunks, :], axis=1)
-        predicted_labels[instance] = stats.mode(predicted.flatten())[0][0]
-        ground_truth_labels[instance] = stats.mode(test_y[i:i + n_chunks])[0][0]
-        instance += 1
+    predicted_labels = vote(prediction, n_chunks, strategy)
+    ground_truth_labels = mode(np.asarray(test_y).reshape(-1, n_chunks))
     return predicted_labels, ground_truth_labels
 
 
-def print_results(accuracy_list, history_list):
+def print_results(accuracy_list, history_list, storage=None):
     """
     Print the results of the training.
 
     :param accuracy_list: list, containing the accuracy of each fold.
-    :param history_list: list, containing the history object of each fold.
+    :param history_list: list, containing the history of each fold.
+    :param storage: tuple, layout, data type and size in bytes of the stored data, as returned by data_storage(),
+    appended with the accuracy to './models/storage_report.csv'. Default is None.
     """
     accuracy_mean = np.mean(accuracy_list)
     print("Mean accuracy: {:.03f}".format(accuracy_mean))
@@ -142,22 +393,83 @@ def print_results(accuracy_list, history_list):
     print("Best model: {0}({1:.03f})".format(model_index, np.max(accuracy_list)))
     plot_history(history_list[model_index])
 
+    if storage is not None:
+        layout, dtype, size = storage
+        print("Data: {} {}, {:.1f} MB".format(layout, dtype, size / 2 ** 20))
+        new = not os.path.exists(storage_report_path)
+        with open(storage_report_path, 'a') as f:
+            if new:
+                f.write('date,layout,dtype,bytes,folds,mean_accuracy,std_accuracy\n')
+            f.write('{},{},{},{},{},{:.4f},{:.4f}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), layout, dtype, size,
+                                                             len(accuracy_list), accuracy_mean, accuracy_std))
+
 
 def check_options(argv):
     """
-    Check for number of channels of the CNN.
+    Check for number of channels of the CNN and the training flags.
 
-    :param argv: [0] - script name (ignored), [1] - options = 2 | 3
+    :param argv: [0] - script name (ignored), [1] - options = 2 | 3, [2:] - flags
+    :return: object, parsed options with the number of channels in options.channel.
     """
-    if len(argv) < 2:
+    if len(argv) < 2 or argv[1] not in ('2', '3'):
         handle_exit()
-    elif len(argv) == 2:
-        if argv[1] == '2':
-            return 2
-        elif argv[1] == '3':
-            return 3
-        else:
-            handle_exit()
+    parser = argparse.ArgumentParser(prog='train.py')
+    parser.add_argument('channel', type=int, choices=[2, 3], help='number of channels of the CNN')
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory-map the data and feed the folds batch by batch instead of loading them in memory')
+    parser.add_argument('--shards', action='store_true',
+                        help='read the shards written by preprocessing.py --shards lazily, implies the generator '
+                             'pipeline by default')
+    parser.add_argument('--spec', action='store_true',
+                        help='slice the chunks lazily from the spectrograms stored by preprocessing.py --full, '
+                             'implies the generator pipeline by default')
+    parser.add_argument('--chunk-size', type=int, default=80,
+                        help='frames per chunk with --spec, at least 60, default is 80')
+    parser.add_argument('--hop', type=int, default=None,
+                        help='frames between consecutive train chunks with --spec, less than the chunk size overlaps '
+                             'them, default is the chunk size')
+    parser.add_argument('--test-hop', type=int, default=None,
+                        help='frames between consecutive test chunks with --spec, whose predictions are voted on')
+    parser.add_argument('--gpus', type=int, default=2, help='number of GPUs the model is replicated on, default is 2')
+    parser.add_argument('--fold-workers', type=int, default=1,
+                        help='number of folds trained concurrently in separate processes, implies --mmap')
+    parser.add_argument('--intra-threads', type=int, default=0,
+                        help='TensorFlow intra-op threads per fold worker, default is the cores divided by the workers')
+    parser.add_argument('--inter-threads', type=int, default=2, help='TensorFlow inter-op threads per fold worker')
+    parser.add_argument('--pipeline', choices=['numpy', 'generator', 'prefetch'], default=None,
+                        help='input pipeline: numpy arrays in memory, a batch generator, or a background prefetching '
+                             'pipeline with a shuffle buffer, default is generator with --mmap and numpy without')
+    parser.add_argument('--shuffle-buffer', type=int, default=2048, help='indices in the shuffle buffer of prefetch')
+    parser.add_argument('--prefetch', type=int, default=8, help='batches prepared ahead by prefetch')
+    parser.add_argument('--throughput', action='store_true', help='print the training samples per second of each epoch')
+    parser.add_argument('--frozen', default=None,
+                        help='train only the head on the features of the conv front end of these weights, e.g. '
+                             './models/cnn_weights_0.h5, computed once into ./models/features, and save the models '
+                             'to ./models/cnn_weights_{fold}_head.h5')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume the interrupted run, skipping completed folds and continuing interrupted ones')
+    parser.add_argument('--seed', type=int, default=None, help='random seed of the K-fold split of a new run')
+    parser.add_argument('--vote', choices=['hard', 'soft', 'log'], default='hard',
+                        help='aggregation of the chunk predictions of each song, default is the majority vote')
+    options = parser.parse_args(argv[1:])
+    if options.shards and options.spec:
+        parser.error('--shards and --spec read different data, choose one')
+    if (options.chunk_size != 80 or options.hop is not None or options.test_hop is not None) and not options.spec:
+        parser.error('--chunk-size, --hop and --test-hop require --spec')
+    if options.chunk_size < 60:
+        parser.error('--chunk-size must be at least 60, the width of the tempo filters')
+    if any(hop is not None and hop < 1 for hop in (options.hop, options.test_hop)):
+        parser.error('--hop and --test-hop must be at least 1')
+    if options.frozen and os.path.abspath(options.frozen) in [os.path.abspath(head_model_path.format(i))
+                                                              for i in range(10)]:
+        parser.error('--frozen must not be one of the ./models/cnn_weights_{fold}_head.h5 models it writes')
+    if options.fold_workers > 1:
+        options.mmap = True
+        if not options.intra_threads:
+            options.intra_threads = max(1, os.cpu_count() // options.fold_workers)
+    if options.pipeline is None:
+        options.pipeline = 'generator' if options.mmap or options.shards or options.spec else 'numpy'
+    return options
 
 
 def handle_exit():
@@ -166,61 +478,662 @@ def handle_exit():
     """
     print('Error: No such number of channels')
     print('Please enter the command in this format:')
-    print("[SCRIPT] [OPTIONS 2 | 3]")
+    print("[SCRIPT] [OPTIONS 2 | 3] [FLAGS]")
     print("\tpython train.py 3")
+    print("\tpython train.py 3 --mmap")
+    print("\tpython train.py 3 --gpus 1 --fold-workers 4")
+    print("\tpython train.py 3 --resume")
+    print("\tpython train.py 3 --mmap --pipeline prefetch --throughput")
+    print("\tpython train.py 3 --shards")
+    print("\tpython train.py 3 --frozen ./models/cnn_weights_0.h5")
+    print("\tpython train.py 3 --spec --hop 40 --test-hop 20")
     sys.exit()
 
 
-def load_data():
+def as_indices(key, length):
+    """
+    Convert the key of an array-like object to non-negative integer indices.
+
+    :param key: int, slice, or 1D array of indices or booleans.
+    :param length: int, length of the array-like object.
+    :return: array, indices, 0D for an int key.
+    """
+    if isinstance(key, slice):
+        key = np.arange(*key.indices(length))
+    indices = np.asarray(key)
+    if indices.dtype == bool:
+        indices = np.flatnonzero(indices)
+    indices = np.where(indices < 0, indices + length, indices)
+    if indices.size and (indices.min() < 0 or indices.max() >= length):
+        raise IndexError('index out of range for {} samples'.format(length))
+    return indices
+
+
+class Dequantized(object):
+    """
+    Data quantized to uint8 by preprocessing.save_data(), indexed like the original array. Only the indexed values are
+    dequantized, to float32.
+    """
+
+    def __init__(self, X, scale, offset):
+        """
+        :param X: array, quantized data, possibly memory-mapped.
+        :param scale: array, scale of each band, broadcastable to X.
+        :param offset: array, offset of each band, broadcastable to X.
+        """
+        self.X = X
+        self.scale = np.broadcast_to(scale, X.shape)
+        self.offset = np.broadcast_to(offset, X.shape)
+        self.shape = X.shape
+        self.ndim = X.ndim
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        """
+        :param key: any numpy index.
+        :return: array, dequantized values.
+        """
+        return self.X[key] * self.scale[key] + self.offset[key]
+
+    def __array__(self, dtype=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+
+def load_array(path, mmap_mode=None):
+    """
+    Load data saved by preprocessing.save_data(). uint8 data is dequantized when indexed, with the scale and offset
+    stored next to it.
+
+    :param path: string, path to the data.
+    :param mmap_mode: string, memory-map mode of the data, e.g. 'r'. Default is None, which loads the data in memory.
+    :return: array, data, or Dequantized data.
+    """
+    X = np.load(path, mmap_mode=mmap_mode)
+    if X.dtype != np.uint8:
+        return X
+    with np.load(os.path.splitext(path)[0] + '_quant.npz') as quant:
+        return Dequantized(X, quant['scale'], quant['offset'])
+
+
+def data_paths(options):
+    """
+    :param options: object, options returned by check_options().
+    :return: list, paths to the files of the stored train and test data the options train on.
+    """
+    if options.shards:
+        paths = []
+        for d in ('./models/train_shards', './models/test_shards'):
+            with open(os.path.join(d, 'index.json')) as f:
+                paths += [os.path.join(d, shard['file']) for shard in json.load(f)['shards']]
+        return paths
+
+    paths = ['./models/{}_{}.npy'.format(s, 'spec' if options.spec else 'X') for s in ('train', 'test')]
+    if np.load(paths[0], mmap_mode='r').dtype == np.uint8:
+        paths += [os.path.splitext(path)[0] + '_quant.npz' for path in paths]
+    return paths
+
+
+def data_storage(options):
+    """
+    Describe the stored data the options train on.
+
+    :param options: object, options returned by check_options().
+    :return: tuple, layout ('chunks', 'spec' or 'shards'), data type and total size in bytes of the train and test data.
+    """
+    size = sum(os.path.getsize(path) for path in data_paths(options))
+    if options.shards:
+        with open('./models/train_shards/index.json') as f:
+            return 'shards', json.load(f)['dtype'], size
+
+    layout = 'spec' if options.spec else 'chunks'
+    dtype = np.load('./models/{}_{}.npy'.format('train', 'spec' if options.spec else 'X'), mmap_mode='r').dtype
+    return layout, str(dtype), size
+
+
+class ShardedArray(object):
+    """
+    Read-only view of the shards written by preprocessing.extract_sharded(), indexed like an array of all the samples.
+    Only the shards listed in the index when the view is created are visible, so a training run started before the
+    extraction ends trains on the shards completed at its start. Each shard is standardized with the mean and standard
+    deviation recorded with it; once the index records those of the whole set, the samples of the other shards are
+    corrected to them as they are read. Shards are memory-mapped when first read, so indexing only reads the samples
+    it gathers.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: string, directory of the shards and their index.json.
+        """
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        shards = index['shards']
+
+        self.path = path
+        self.files = [shard['file'] for shard in shards]
+        self.offsets = np.cumsum([0] + [shard['length'] for shard in shards])
+        self.shape = (int(self.offsets[-1]),) + tuple(index['shape'])
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(index['dtype'])
+        labels = [track['label'] for track in index['tracks'] if track['shard'] < len(shards)]
+        self.labels = np.repeat(labels, index['samples_per_track'])
+        self.shards = [None] * len(shards)
+
+        # x standardized with (mean, std) of its shard is corrected to (mean_all, std_all) by x * scale + shift
+        self.corrections = [None] * len(shards)
+        if index['mean'] is not None:
+            mean, std = (np.reshape(index[key], (-1, 1, 1)) for key in ('mean', 'std'))
+            for i, shard in enumerate(shards):
+                shard_mean, shard_std = (np.reshape(shard[key], (-1, 1, 1)) for key in ('mean', 'std'))
+                if not (np.array_equal(shard_mean, mean) and np.array_equal(shard_std, std)):
+                    self.corrections[i] = (shard_std / std, (shard_mean - mean) / std)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def shard(self, shard_index):
+        """
+        :param shard_index: int, index of the shard.
+        :return: array, memory-mapped samples of the shard.
+        """
+        if self.shards[shard_index] is None:
+            self.shards[shard_index] = np.load(os.path.join(self.path, self.files[shard_index]), mmap_mode='r')
+        return self.shards[shard_index]
+
+    def correct(self, shard_index, X):
+        """
+        :param shard_index: int, index of the shard the samples were read from.
+        :param X: array, samples of the shard.
+        :return: array, samples standardized with the mean and standard deviation of the whole set when they are known.
+        """
+        if self.corrections[shard_index] is None:
+            return X
+        scale, shift = self.corrections[shard_index]
+        return X * scale + shift
+
+    def __getitem__(self, key):
+        """
+        :param key: int, slice, or 1D array of indices or booleans.
+        :return: array, gathered samples.
+        """
+        indices = as_indices(key, len(self))
+        shard_indices = np.searchsorted(self.offsets, indices, side='right') - 1
+        if indices.ndim == 0:
+            shard_index = int(shard_indices)
+            return self.correct(shard_index, np.array(self.shard(shard_index)[indices - self.offsets[shard_index]]))
+
+        X = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        for shard_index in np.unique(shard_indices):
+            mask = shard_indices == shard_index
+            X[mask] = self.correct(shard_index, self.shard(shard_index)[indices[mask] - self.offsets[shard_index]])
+        return X
+
+    def __array__(self, dtype=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+
+class ChunkView(object):
+    """
+    Chunks of full spectrograms, chunk_size frames long and hop frames apart, indexed like an array of chunks and
+    sliced from the spectrograms only when indexed, so overlapping chunks take no extra memory or disk. Sample i is
+    chunk i % n_chunks of track i // n_chunks.
+    """
+
+    def __init__(self, spec, chunk_size=80, hop=None):
+        """
+        :param spec: 3D array, tracks x mels x frames normalized spectrograms, possibly memory-mapped.
+        :param chunk_size: int, number of frames per chunk. Default is 80.
+        :param hop: int, number of frames between the start of consecutive chunks. Default is None, which is
+        chunk_size.
+        """
+        self.spec = spec
+        self.chunk_size = chunk_size
+        self.hop = chunk_size if hop is None else hop
+        self.n_chunks = 1 + (spec.shape[2] - chunk_size) // self.hop
+        self.shape = (len(spec) * self.n_chunks, spec.shape[1], chunk_size, 1)
+        self.ndim = len(self.shape)
+        self.dtype = spec.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        """
+        :param key: int, slice, or 1D array of indices or booleans.
+        :return: array, sliced chunks.
+        """
+        indices = as_indices(key, len(self))
+        tracks, chunks = np.divmod(np.atleast_1d(indices), self.n_chunks)
+        X = np.empty((len(tracks),) + self.shape[1:], dtype=self.dtype)
+        for i, (track, start) in enumerate(zip(tracks, chunks * self.hop)):
+            X[i, ..., 0] = self.spec[track, :, start:start + self.chunk_size]
+        return X[0] if indices.ndim == 0 else X
+
+    def __array__(self, dtype=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+
+def load_data(mmap_mode=None, shards=False, spec=False, chunk_size=80, hop=None, test_hop=None):
     """
     Load the data and labels of the train and test set.
 
+    :param mmap_mode: string, memory-map mode of the data, e.g. 'r'. Default is None, which loads the data in memory.
+    :param shards: bool, whether to read the shards in './models/train_shards' and './models/test_shards' lazily
+    instead of the .npy files. Default is False.
+    :param spec: bool, whether to slice the chunks lazily from the full spectrograms in './models/train_spec.npy' and
+    './models/test_spec.npy'. Default is False.
+    :param chunk_size: int, number of frames per chunk with spec. Default is 80.
+    :param hop: int, number of frames between the start of consecutive train chunks with spec. Default is None, which
+    is chunk_size.
+    :param test_hop: int, number of frames between the start of consecutive test chunks with spec. Default is None,
+    which is chunk_size.
     :return: train_X, train data; train_y, train labels; test_X, test data; test_y, test labels.
     """
-    train_X = np.load('./models/train_X.npy')
+    if spec:
+        train_X = ChunkView(load_array('./models/train_spec.npy', mmap_mode), chunk_size, hop)
+        train_y = np.repeat(np.load('./models/train_spec_y.npy'), train_X.n_chunks)
+        test_X = ChunkView(load_array('./models/test_spec.npy', mmap_mode), chunk_size, test_hop)
+        test_y = np.repeat(np.load('./models/test_spec_y.npy'), test_X.n_chunks)
+        return train_X, to_categorical(train_y, num_classes=10), test_X, test_y
+
+    if shards:
+        train_X = ShardedArray('./models/train_shards')
+        test_X = ShardedArray('./models/test_shards')
+        return train_X, to_categorical(train_X.labels, num_classes=10), test_X, test_X.labels
+
+    train_X = load_array('./models/train_X.npy', mmap_mode)
     train_y = np.load('./models/train_y.npy')
     train_y = to_categorical(train_y, num_classes=10)
-    test_X = np.load('./models/test_X.npy')
+    test_X = load_array('./models/test_X.npy', mmap_mode)
     test_y = np.load('./models/test_y.npy')
     return train_X, train_y, test_X, test_y
 
 
-if __name__ == '__main__':
-    channel = check_options(sys.argv)
-    epochs = 2000
-    batch_size = 20
-    n_chunks = 16.
+def batch_generator(X, y, indices, batch_size, shuffle=True):
+    """
+    Generate batches of the data at the given indices. Each batch is gathered on its own, so only one batch of a
+    memory-mapped array is read into memory and a fold is never copied as a whole.
 
-    train_X, train_y, test_X, test_y = load_data()
+    :param X: array, data, possibly memory-mapped.
+    :param y: array, labels.
+    :param indices: 1D array, indices of the samples to be generated.
+    :param batch_size: int, number of samples per batch.
+    :param shuffle: bool, whether to shuffle the indices at every epoch. Default is True.
+    :return: generator, yielding tuples of batch data and labels indefinitely.
+    """
+    indices = np.asarray(indices)
+    while True:
+        order = np.random.permutation(indices) if shuffle else indices
+        for i in range(0, len(order), batch_size):
+            # sorted indices read the memory-mapped file sequentially
+            batch = np.sort(order[i:i + batch_size])
+            yield X[batch], y[batch]
 
-    # K-Fold
-    n_splits = 10
-    kfold = KFold(n_splits=n_splits, shuffle=True)
-    fold_index = 0
-    accuracy_list = []
-    history_list = []
-    for train, val in kfold.split(train_X, train_y):
-        model = cnn(channel)
 
-        history = model.fit(train_X[train], train_y[train], validation_data=(train_X[val], train_y[val]), epochs=epochs,
-                            batch_size=batch_size, verbose=2, callbacks=callbacks())
-        history_list.append(history)
+def steps(indices, batch_size):
+    """
+    Number of batches needed to go through the indices once.
 
-        model.load_weights('./models/cnn_weights_{}.h5'.format(fold_index))  # load best weights
+    :param indices: 1D array, indices of the samples.
+    :param batch_size: int, number of samples per batch.
+    :return: int, number of batches.
+    """
+    return int(np.ceil(len(indices) / batch_size))
+
+
+def shuffle_stream(stream, buffer_size):
+    """
+    Shuffle a stream of values with a buffer of bounded size: once the buffer is full, every incoming value replaces
+    a random value of the buffer, which is emitted.
 
-        prediction = model.predict(test_X, verbose=2)
+    :param stream: iterable, values to be shuffled.
+    :param buffer_size: int, number of values in the buffer.
+    :return: generator, yielding the shuffled values.
+    """
+    buffer = []
+    for value in stream:
+        if len(buffer) < buffer_size:
+            buffer.append(value)
+            continue
+        i = np.random.randint(buffer_size)
+        yield buffer[i]
+        buffer[i] = value
+    np.random.shuffle(buffer)
+    for value in buffer:
+        yield value
+
+
+def pipeline(X, y, indices, batch_size, buffer_size=2048, prefetch=8, block_size=256):
+    """
+    Input pipeline preparing the batches of the samples at the given indices on a background thread. Every epoch, the
+    sorted indices are split into blocks visited in random order and shuffled through a buffer of bounded size, so the
+    samples of a batch come from a bounded region of a memory-mapped array. Up to prefetch batches are gathered ahead
+    of the training step. An exception raised while gathering a batch is raised by the generator, and closing the
+    generator stops the thread.
+
+    :param X: array, data, possibly memory-mapped.
+    :param y: array, labels.
+    :param indices: 1D array, indices of the samples to be generated.
+    :param batch_size: int, number of samples per batch.
+    :param buffer_size: int, number of indices in the shuffle buffer. Default is 2048.
+    :param prefetch: int, number of batches prepared ahead. Default is 8.
+    :param block_size: int, number of consecutive indices visited together. Default is 256.
+    :return: generator, yielding tuples of batch data and labels indefinitely, steps(indices, batch_size) per epoch.
+    """
+    indices = np.sort(indices)
+    blocks = [indices[i:i + block_size] for i in range(0, len(indices), block_size)]
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
 
-        predicted_labels, ground_truth_labels = convert_to_cm_labels(test_y, prediction)
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-        cm = confusion_matrix(ground_truth_labels, predicted_labels)
+    def produce():
+        try:
+            while True:
+                stream = (i for block in np.random.permutation(len(blocks)) for i in blocks[block])
+                order = np.fromiter(shuffle_stream(stream, buffer_size), dtype=indices.dtype, count=len(indices))
+                for i in range(0, len(order), batch_size):
+                    batch = np.sort(order[i:i + batch_size])
+                    if not put((X[batch], y[batch])):
+                        return
+        except Exception as e:
+            put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = batches.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+class Throughput(Callback):
+    """
+    Print the number of training samples processed per second in every epoch, excluding the validation.
+    """
+
+    def __init__(self, n_samples):
+        """
+        :param n_samples: int, number of training samples per epoch.
+        """
+        super(Throughput, self).__init__()
+        self.n_samples = n_samples
+        self.rates = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        self.end = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.rates.append(self.n_samples / (self.end - self.start))
+        print('Epoch {}: {:.1f} samples/sec'.format(epoch + 1, self.rates[-1]))
+
+    def on_train_end(self, logs=None):
+        if self.rates:
+            print('Mean throughput: {:.1f} samples/sec'.format(np.mean(self.rates)))
+
+
+def save_json(path, content):
+    """
+    Write a JSON file atomically, so an interrupted run never leaves a partial file.
+
+    :param path: string, path to the file.
+    :param content: object, content to be written.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+
+def load_fold_state(fold_index):
+    """
+    Load the persisted state of a fold.
+
+    :param fold_index: int, index of the fold.
+    :return: dict, state of the fold, or None if the fold was never started.
+    """
+    path = fold_state_path.format(fold_index)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def kfold_splits(options, n_samples, n_splits=10, n_chunks=1):
+    """
+    Create the K-fold splits of a new run and persist them with the run manifest, or load those of the interrupted run
+    when options.resume is set.
+
+    :param options: object, options returned by check_options().
+    :param n_samples: int, number of training samples.
+    :param n_splits: int, number of folds. Default is 10.
+    :param n_chunks: int, number of consecutive samples per track, which are kept in the same fold, so that overlapping
+    chunks of a validation track are not trained on. Default is 1, which splits the samples.
+    :return: list, tuples of the training and validation indices of each fold.
+    """
+    # the fold state, weights and optimizer files of the head of a frozen run and of a full run are not interchangeable
+    run = {'channel': options.channel, 'n_samples': n_samples, 'n_splits': n_splits, 'n_chunks': n_chunks,
+           'chunk_size': options.chunk_size, 'frozen': os.path.abspath(options.frozen) if options.frozen else None}
+    if options.resume and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if any(manifest.get(key) != value for key, value in run.items()):
+            sys.exit('Error: {} does not match this run, {} != {}'.format(manifest_path, manifest, run))
+        splits = np.load(splits_path)
+        print('Resuming the run created on {}'.format(manifest['created']))
+        return [(splits['train_{}'.format(i)], splits['val_{}'.format(i)]) for i in range(n_splits)]
 
-        accuracy = np.sum(np.diag(cm)) / (len(test_y) / n_chunks)
+    seed = options.seed if options.seed is not None else np.random.randint(2 ** 31)
+    kfold = KFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    chunks = np.arange(n_chunks)
+    folds = [(np.ravel(train[:, None] * n_chunks + chunks), np.ravel(val[:, None] * n_chunks + chunks))
+             for train, val in kfold.split(np.zeros(n_samples // n_chunks))]
+    for i in range(n_splits):
+        for path in (fold_state_path, fold_weights_path, fold_optimizer_path):
+            if os.path.exists(path.format(i)):
+                os.remove(path.format(i))
+    arrays = {}
+    for i, (train, val) in enumerate(folds):
+        arrays['train_{}'.format(i)] = train
+        arrays['val_{}'.format(i)] = val
+    np.savez(splits_path, **arrays)
+    run.update(seed=seed, created=time.strftime('%Y-%m-%d %H:%M:%S'))
+    save_json(manifest_path, run)
+    return folds
+
+
+def fit(model, train_X, train_y, train, val, options, fold_callbacks, initial_epoch=0, epochs=2000, batch_size=20):
+    """
+    Fit the CNN on the training samples of a fold, validating on its validation samples.
+
+    :param model: object, model of the CNN.
+    :param train_X: array, train data, possibly memory-mapped.
+    :param train_y: array, train labels.
+    :param train: 1D array, indices of the training samples of the fold.
+    :param val: 1D array, indices of the validation samples of the fold.
+    :param options: object, options returned by check_options().
+    :param fold_callbacks: list, callbacks of the fold.
+    :param initial_epoch: int, epoch at which to start training. Default is 0.
+    :param epochs: int, maximum number of epochs. Default is 2000.
+    :param batch_size: int, number of samples per batch. Default is 20.
+    """
+    if options.throughput:
+        fold_callbacks = [Throughput(len(train))] + fold_callbacks
+    if options.pipeline == 'prefetch':
+        batches = pipeline(train_X, train_y, train, batch_size, options.shuffle_buffer, options.prefetch)
+        try:
+            model.fit_generator(batches, steps_per_epoch=steps(train, batch_size),
+                                validation_data=batch_generator(train_X, train_y, val, batch_size, shuffle=False),
+                                validation_steps=steps(val, batch_size), epochs=epochs, verbose=2,
+                                callbacks=fold_callbacks, initial_epoch=initial_epoch)
+        finally:
+            # stop the producer thread, which holds the data and the prefetched batches
+            batches.close()
+    elif options.pipeline == 'generator':
+        model.fit_generator(batch_generator(train_X, train_y, train, batch_size),
+                            steps_per_epoch=steps(train, batch_size),
+                            validation_data=batch_generator(train_X, train_y, val, batch_size, shuffle=False),
+                            validation_steps=steps(val, batch_size), epochs=epochs, verbose=2,
+                            callbacks=fold_callbacks, initial_epoch=initial_epoch)
+    else:
+        model.fit(train_X[train], train_y[train], validation_data=(train_X[val], train_y[val]), epochs=epochs,
+                  batch_size=batch_size, verbose=2, callbacks=fold_callbacks, initial_epoch=initial_epoch)
+
+
+def train_fold(fold_index, train, val, data, options, epochs=2000, batch_size=20):
+    """
+    Train the CNN on a fold and evaluate its best weights on the test set. A fold interrupted in a previous run resumes
+    from its last completed epoch, and a completed fold is not trained again.
+
+    :param fold_index: int, index of the fold.
+    :param train: 1D array, indices of the training samples of the fold.
+    :param val: 1D array, indices of the validation samples of the fold.
+    :param data: tuple, train_X, train_y, test_X and test_y as returned by load_data().
+    :param options: object, options returned by check_options().
+    :param epochs: int, maximum number of epochs. Default is 2000.
+    :param batch_size: int, number of samples per batch. Default is 20.
+    :return: accuracy, float, test accuracy of the fold; history, dict, history of the CNN; cm, 2D array, confusion
+    matrix.
+    """
+    state = load_fold_state(fold_index)
+    if state is not None and state['status'] == 'done':
+        print('Fold {} is already done'.format(fold_index))
+        return state['accuracy'], state['history'], np.asarray(state['cm'])
+
+    train_X, train_y, test_X, test_y = data
+    n_chunks = test_X.n_chunks if isinstance(test_X, ChunkView) else 16
+    if options.frozen:
+        model, front_end, trained = frozen_cnn(options.channel, options.frozen, options.gpus, train_X.shape[2])
+        train_X, test_X = feature_store(front_end, options, train_X, test_X)
+        weights_path = head_weights_path
+    else:
+        model = cnn(options.channel, gpu_count=options.gpus, plot=False, chunk_size=train_X.shape[2])
+        trained = model
+        weights_path = './models/cnn_weights_{}.h5'
+    fold_callbacks = callbacks(fold_index, weights_path)
+    fold_state = FoldState(fold_index, fold_callbacks, state)
+    fold_callbacks.append(fold_state)
+
+    if fold_state.state['status'] != 'trained':
+        fit(trained, train_X, train_y, train, val, options, fold_callbacks, fold_state.state['epoch'], epochs,
+            batch_size)
+
+    trained.load_weights(weights_path.format(fold_index))  # load best weights
+    if options.frozen:
+        # the head shares its layers with the whole CNN, which predict.py and server.py load with --weights, next to
+        # the end-to-end model of the fold, which may be the frozen one
+        model.save_weights(head_model_path.format(fold_index))
+
+    prediction = trained.predict(test_X, verbose=2)
+
+    predicted_labels, ground_truth_labels = convert_to_cm_labels(test_y, prediction, options.vote, n_chunks)
+
+    cm = confusion_matrix(ground_truth_labels, predicted_labels)
+
+    accuracy = np.sum(np.diag(cm)) / len(ground_truth_labels)
+
+    fold_state.finish(accuracy, cm)
+    return accuracy, fold_state.history, cm
+
+
+def limit_threads(intra_threads, inter_threads):
+    """
+    Limit the number of threads TensorFlow uses in this process.
+
+    :param intra_threads: int, number of threads running a single operation, 0 lets TensorFlow decide.
+    :param inter_threads: int, number of operations running concurrently, 0 lets TensorFlow decide.
+    """
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_threads, inter_op_parallelism_threads=inter_threads,
+                            allow_soft_placement=True)
+    K.set_session(tf.Session(config=config))
+
+
+def prepare_folds(data, options):
+    """
+    Do the work shared by all the folds once, before they are trained: plot the model, or with --frozen, compute the
+    features of the front end, which every fold then reads from the feature store.
+
+    :param data: tuple, train_X, train_y, test_X and test_y as returned by load_data().
+    :param options: object, options returned by check_options().
+    """
+    train_X, _, test_X, _ = data
+    if options.frozen:
+        _, front_end, _ = frozen_cnn(options.channel, options.frozen, options.gpus, train_X.shape[2])
+        feature_store(front_end, options, train_X, test_X)
+    else:
+        cnn(options.channel, gpu_count=options.gpus, chunk_size=train_X.shape[2])
+
+
+def prepare_worker(options):
+    """
+    Run prepare_folds() in a worker process, so the parent process of the fold workers does not hold a TensorFlow
+    session.
+
+    :param options: object, options returned by check_options().
+    """
+    limit_threads(options.intra_threads, options.inter_threads)
+    data = load_data('r', options.shards, options.spec, options.chunk_size, options.hop, options.test_hop)
+    prepare_folds(data, options)
+
+
+def fold_worker(args):
+    """
+    Train a fold in a worker process. The data is memory-mapped, so the page cache is shared by all the workers.
+
+    :param args: tuple, fold index, training indices, validation indices and options.
+    :return: tuple, as returned by train_fold().
+    """
+    fold_index, train, val, options = args
+    limit_threads(options.intra_threads, options.inter_threads)
+    data = load_data('r', options.shards, options.spec, options.chunk_size, options.hop, options.test_hop)
+    return train_fold(fold_index, train, val, data, options)
+
+
+if __name__ == '__main__':
+    options = check_options(sys.argv)
+
+    train_X, train_y, test_X, test_y = load_data('r' if options.mmap else None, options.shards, options.spec,
+                                                 options.chunk_size, options.hop, options.test_hop)
+
+    # K-Fold
+    n_splits = 10
+    # the chunks of a track overlap with --hop, so the folds split the tracks
+    n_chunks = train_X.n_chunks if isinstance(train_X, ChunkView) else 1
+    folds = [(fold_index, train, val, options)
+             for fold_index, (train, val) in enumerate(kfold_splits(options, len(train_X), n_splits, n_chunks))]
+    if options.fold_workers > 1:
+        # spawn fresh processes, TensorFlow does not survive a fork
+        pool = multiprocessing.get_context('spawn').Pool(options.fold_workers, maxtasksperchild=1)
+        pool.apply(prepare_worker, (options,))
+        results = pool.imap(fold_worker, folds)
+    else:
+        prepare_folds((train_X, train_y, test_X, test_y), options)
+        results = (train_fold(fold_index, train, val, (train_X, train_y, test_X, test_y), options)
+                   for fold_index, train, val, _ in folds)
+
+    accuracy_list = []
+    history_list = []
+    for fold_index, (accuracy, history, cm) in enumerate(results):
         accuracy_list.append(accuracy)
+        history_list.append(history)
 
         print("In the {0} fold, the classification accuracy is {1:.03f}".format(fold_index, accuracy_list[fold_index]))
         print("and the confusion matrix is: ")
         print(cm, end='\n\n')
 
-        fold_index += 1
-
-    print_results(accuracy_list, history_list)
+    print_results(accuracy_list, history_list, data_storage(options))
@@ -0,0 +1,111 @@
+import argparse
+import time
+
+import librosa
+import numpy as np
+import scipy.signal
+
+from preprocessing import au_duration, batch_spectrogram, list_files, load_audio, melspectrogram, sr
+
+
+def best_time(function, repeat=3):
+    """
+    Measure the best wall time of a function over several runs.
+
+    :param function: callable, function to be timed, called without arguments.
+    :param repeat: int, number of runs. Default is 3.
+    :return: float, best time in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def bench_decoding(files, repeat=3):
+    """
+    Compare the time per track of decoding the whole file with librosa and resampling it, as the original
+    preprocessing did, with decoding only the first au_duration seconds and resampling them with either resampler.
+
+    :param files: list, paths to the audio files.
+    :param repeat: int, number of runs of each variant. Default is 3.
+    """
+    def whole_file():
+        for file in files:
+            librosa.core.load(file, sr=sr)
+
+    def first_seconds(resampler):
+        def function():
+            for file in files:
+                load_audio(file, sr, resampler)
+        return function
+
+    print('Decoding of {} tracks'.format(len(files)))
+    for name, function in (('librosa, whole file', whole_file), ('first seconds, best', first_seconds('best')),
+                           ('first seconds, fast', first_seconds('fast'))):
+        print('{:>24}: {:.1f} ms/track'.format(name, 1000 * best_time(function, repeat) / len(files)))
+
+
+def bench_filterbank(signals, repeat=3):
+    """
+    Compare the time per track of the mel-spectrogram with the window and mel filterbank rebuilt on every call, as
+    librosa.feature.melspectrogram does, and with the cached ones.
+
+    :param signals: 2D array, tracks x samples.
+    :param repeat: int, number of runs of each variant. Default is 3.
+    """
+    def uncached():
+        for y in signals:
+            window = scipy.signal.get_window('blackmanharris', 2048, fftbins=False)
+            spec = np.abs(librosa.stft(y=y, hop_length=1024, window=window, win_length=2048)) ** 2
+            librosa.feature.melspectrogram(sr=sr, S=spec, hop_length=1024, n_mels=40)
+
+    def cached():
+        for y in signals:
+            melspectrogram(y)
+
+    print('Mel-spectrogram of {} tracks of {} s'.format(len(signals), au_duration))
+    for name, function in (('uncached filterbank', uncached), ('cached filterbank', cached)):
+        print('{:>24}: {:.1f} ms/track'.format(name, 1000 * best_time(function, repeat) / len(signals)))
+
+
+def bench_engines(signals, batch_size=8, repeat=3):
+    """
+    Compare the tracks per second of the per-track librosa spectrogram with the batched spectrogram.
+
+    :param signals: 2D array, tracks x samples.
+    :param batch_size: int, number of tracks per batch of the batched spectrogram. Default is 8.
+    :param repeat: int, number of runs of each engine. Default is 3.
+    """
+    def per_track():
+        for y in signals:
+            melspectrogram(y)
+
+    def batched():
+        for i in range(0, len(signals), batch_size):
+            batch_spectrogram(signals[i:i + batch_size])
+
+    print('STFT + mel of {} tracks of {} s'.format(len(signals), au_duration))
+    for name, function in (('librosa, per track', per_track), ('batched, {} tracks'.format(batch_size), batched)):
+        print('{:>24}: {:.1f} tracks/sec'.format(name, len(signals) / best_time(function, repeat)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the spectrogram computation.')
+    parser.add_argument('path', nargs='?', help='directory of .au files, default is white noise')
+    parser.add_argument('--tracks', type=int, default=32, help='number of tracks')
+    parser.add_argument('--batch-size', type=int, default=8, help='number of tracks per batch')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the best one is reported')
+    args = parser.parse_args()
+
+    if args.path:
+        files = [file for file, _ in list_files(args.path)[:args.tracks]]
+        bench_decoding(files, args.repeat)
+        signals = np.stack([load_audio(file) for file in files])
+    else:
+        signals = np.random.RandomState(0).uniform(-1, 1, (args.tracks, sr * au_duration)).astype(np.float32)
+
+    bench_filterbank(signals, args.repeat)
+    bench_engines(signals, args.batch_size, args.repeat)
@@ -0,0 +1,149 @@
+import argparse
+import os
+import shutil
+import sys
+
+import h5py
+import numpy as np
+from keras import Model
+
+from preprocessing import count_chunks, n_samples, spec_len
+from train import cudnn_lstm_weights, load_cnn
+
+
+def cudnn_lstm_groups(f):
+    """
+    Find the weights of the CuDNNLSTM layers in a checkpoint, recognized by their bias of 8 x units.
+
+    :param f: object, checkpoint opened with h5py.
+    :return: list, names of the groups holding the kernel, recurrent kernel and bias of each CuDNNLSTM.
+    """
+    groups = []
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Group) and all(key in obj for key in ('kernel:0', 'recurrent_kernel:0', 'bias:0')):
+            if obj['bias:0'].shape == (8 * obj['recurrent_kernel:0'].shape[0],):
+                groups.append(name)
+
+    f.visititems(visit)
+    return groups
+
+
+def convert_checkpoint(weights_path, output_path):
+    """
+    Convert the checkpoint of a model trained with CuDNNLSTM, e.g. './models/cnn_weights_0.h5', into a checkpoint of
+    the same model built with cnn(lstm='cpu'). The kernels of each gate are transposed into the layout of the LSTM
+    and the biases are summed, see train.cudnn_lstm_weights(). The other weights are copied as they are.
+
+    :param weights_path: string, path to the CuDNNLSTM checkpoint.
+    :param output_path: string, path to the converted checkpoint.
+    :return: int, number of converted LSTM layers.
+    """
+    shutil.copyfile(weights_path, output_path)
+    with h5py.File(output_path, 'r+') as f:
+        groups = cudnn_lstm_groups(f)
+        for name in groups:
+            group = f[name]
+            keys = ('kernel:0', 'recurrent_kernel:0', 'bias:0')
+            weights = cudnn_lstm_weights([group[key][...] for key in keys])
+            for key, value in zip(keys, weights):
+                del group[key]
+                group.create_dataset(key, data=value)
+    return len(groups)
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def cudnn_params(kernel, recurrent_kernel, bias):
+    """
+    Build the cuDNN parameter buffer the way CuDNNLSTM does, the kernel and the recurrent kernel of each gate flattened
+    in row-major order, followed by the biases, and read it back the way cuDNN does, as one matrix per gate applied to
+    the column of the input or of the hidden state.
+
+    :param kernel: 2D array, features x (4 * units) kernel of the CuDNNLSTM.
+    :param recurrent_kernel: 2D array, units x (4 * units) recurrent kernel of the CuDNNLSTM.
+    :param bias: 1D array, 8 * units input and recurrent biases of the CuDNNLSTM.
+    :return: tuple, lists of the units x features input matrices, units x units recurrent matrices, input biases and
+    recurrent biases of the gates input, forget, cell and output.
+    """
+    units = recurrent_kernel.shape[0]
+    features = kernel.shape[0]
+    buffer = np.concatenate([k.ravel() for k in np.hsplit(kernel, 4)] +
+                            [k.ravel() for k in np.hsplit(recurrent_kernel, 4)] + [bias])
+    sizes = [units * features] * 4 + [units * units] * 4 + [units] * 8
+    params = np.split(buffer, np.cumsum(sizes)[:-1])
+    return ([w.reshape(units, features) for w in params[:4]], [r.reshape(units, units) for r in params[4:8]],
+            params[8:12], params[12:])
+
+
+def cudnn_lstm(x, kernel, recurrent_kernel, bias):
+    """
+    Reference implementation of the CuDNNLSTM on its parameter buffer, see cudnn_params(), with its separate input and
+    recurrent biases.
+
+    :param x: 3D array, batch x steps x features.
+    :param kernel: 2D array, features x (4 * units) kernel of the CuDNNLSTM.
+    :param recurrent_kernel: 2D array, units x (4 * units) recurrent kernel of the CuDNNLSTM.
+    :param bias: 1D array, 8 * units input and recurrent biases of the CuDNNLSTM.
+    :return: 2D array, batch x units, last output.
+    """
+    w, r, b_w, b_r = cudnn_params(kernel, recurrent_kernel, bias)
+    units = recurrent_kernel.shape[0]
+    h = np.zeros((units, len(x)))
+    c = np.zeros((units, len(x)))
+    for t in range(x.shape[1]):
+        i, f, g, o = (w[k].dot(x[:, t].T) + b_w[k][:, None] + r[k].dot(h) + b_r[k][:, None] for k in range(4))
+        c = sigmoid(f) * c + sigmoid(i) * np.tanh(g)
+        h = sigmoid(o) * np.tanh(c)
+    return h.T
+
+
+def parity(model, weights_path, n_songs=8, seed=0):
+    """
+    Compare the predictions of a model with converted weights with the reference CuDNNLSTM on the original weights, for
+    random inputs. The CNN tower is shared, so the difference only comes from the LSTM.
+
+    :param model: object, single-device model built with lstm='cpu' and loaded with the converted weights.
+    :param weights_path: string, path to the original CuDNNLSTM checkpoint.
+    :param n_songs: int, number of random songs. Default is 8.
+    :param seed: int, seed of the random songs. Default is 0.
+    :return: float, largest absolute difference of the probabilities.
+    """
+    with h5py.File(weights_path, 'r') as f:
+        group = f[cudnn_lstm_groups(f)[0]]
+        kernel, recurrent_kernel, bias = (group[key][...] for key in ('kernel:0', 'recurrent_kernel:0', 'bias:0'))
+    X = np.random.RandomState(seed).randn(n_songs, *model.input_shape[1:]).astype(np.float32)
+    embeddings = Model(inputs=model.input, outputs=model.get_layer('lstm_1').input).predict(X)
+    output_kernel, output_bias = model.get_layer('dense_3').get_weights()
+    logits = cudnn_lstm(embeddings, kernel, recurrent_kernel, bias).dot(output_kernel) + output_bias
+    reference = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+    reference /= np.sum(reference, axis=1, keepdims=True)
+    return float(np.max(np.abs(model.predict(X) - reference)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert CuDNNLSTM weights for CPU inference.')
+    parser.add_argument('--channel', type=int, choices=[2, 3], default=3, help='number of channels of the CNN')
+    parser.add_argument('--fold', type=int, default=0, help='fold of the weights in ./models')
+    parser.add_argument('--weights', help='path to the weights, overrides --fold')
+    parser.add_argument('--output', help='path to the converted weights, default is the weights path ending in _cpu.h5')
+    parser.add_argument('--gpus', type=int, default=2, help='number of GPUs the model was trained on')
+    parser.add_argument('--chunk-size', type=int, default=n_samples,
+                        help='frames per chunk the model was trained on with train.py --spec --chunk-size')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the converted model with the reference CuDNNLSTM on random inputs')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='largest difference of the probabilities')
+    args = parser.parse_args()
+
+    weights_path = args.weights or './models/cnn_weights_{}.h5'.format(args.fold)
+    output_path = args.output or os.path.splitext(weights_path)[0] + '_cpu.h5'
+    print('Converted {} LSTM layer(s) into {}'.format(convert_checkpoint(weights_path, output_path), output_path))
+    if args.check:
+        model = load_cnn(args.channel, output_path, args.gpus, args.chunk_size,
+                         count_chunks(spec_len, args.chunk_size), 'cpu')
+        difference = parity(model, weights_path)
+        print('Largest difference of the probabilities: {:.2e}'.format(difference))
+        if difference > args.tolerance:
+            sys.exit('Parity check failed')
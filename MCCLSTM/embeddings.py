@@ -0,0 +1,207 @@
+import hashlib
+import os
+import time
+import uuid
+
+import numpy as np
+from keras import backend as K
+from keras import Input, Model
+
+
+def tower_key(tower):
+    """
+    :param tower: object, model of the CNN tower, see train.chunk_tower().
+    :return: string, hash of the input shape and weights of the tower, which identifies the embeddings it computes.
+    """
+    digest = hashlib.sha1(str(tower.input_shape).encode())
+    for weights in tower.get_weights():
+        digest.update(np.ascontiguousarray(weights))
+    return digest.hexdigest()
+
+
+def chunk_key(chunk):
+    """
+    :param chunk: array, normalized chunk, 40 x chunk_size x 1.
+    :return: string, hash of the chunk in single precision.
+    """
+    return hashlib.sha1(np.ascontiguousarray(chunk, dtype=np.float32)).hexdigest()
+
+
+def lstm_head(model):
+    """
+    Build the head of a trained model, from the sequence of chunk embeddings to the probabilities. The head calls the
+    LSTM and output layers of the model, so it shares their weights.
+
+    :param model: object, single-device model returned by train.load_cnn().
+    :return: object, model of the head, songs x n_chunks x embedding size to songs x 10 probabilities.
+    """
+    lstm = model.get_layer('lstm_1')
+    inputs = Input(shape=K.int_shape(lstm.input)[1:])
+    return Model(inputs=inputs, outputs=model.get_layer('dense_3')(lstm(inputs)))
+
+
+class EmbeddingCache(object):
+    """
+    Cache of the chunk embeddings, the dense_1 output of the CNN tower, keyed by the hash of the chunk. Every distinct
+    chunk goes through the tower once, whether it is repeated within a batch, by overlapping chunks, or across calls.
+    The cache of a tower is stored in cache_dir/<tower key>/, so repeated scoring, the folds of an ensemble sharing a
+    tower and sweeps of the LSTM head reuse the embeddings across runs, while a retrained tower starts a new cache.
+
+    The directory is an append-only store of segments of at most segment_size embeddings: <name>.npy, memory-mapped
+    when read, and <name>.keys.npy, written last. Only the keys of the stored embeddings and the embeddings of the
+    segment being filled are held in memory. A segment is written once, under a unique name, so
+    concurrent scorers add their segments side by side and pick up those of the others at every save. Once the store
+    holds more than max_embeddings embeddings, its oldest segments are removed.
+    """
+
+    def __init__(self, tower, cache_dir='./models/embeddings', segment_size=4096, max_embeddings=1000000):
+        """
+        :param tower: object, model of the CNN tower, see train.chunk_tower().
+        :param cache_dir: string, directory of the cache files. Default is './models/embeddings'.
+        :param segment_size: int, number of new embeddings written together as a segment. Default is 4096.
+        :param max_embeddings: int, number of stored embeddings above which the oldest segments are removed. Default
+        is 1000000, about 1.6 GB of embeddings of the 3-channel model.
+        """
+        self.tower = tower
+        self.path = os.path.join(cache_dir, tower_key(tower))
+        self.segment_size = segment_size
+        self.max_embeddings = max_embeddings
+        # key -> (segment, row), with segment None for the embeddings not written yet
+        self.index = {}
+        self.segments = {}
+        self.sizes = {}
+        self.new_keys = []
+        self.new_embeddings = []
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        """
+        Add the segments written since the last call, by this or another process, to the index.
+        """
+        if not os.path.isdir(self.path):
+            return
+        names = sorted(name[:-len('.keys.npy')] for name in os.listdir(self.path) if name.endswith('.keys.npy'))
+        for name in names:
+            if name in self.sizes:
+                continue
+            try:
+                keys = np.load(os.path.join(self.path, name + '.keys.npy'))
+            except IOError:  # removed by another process
+                continue
+            for row, key in enumerate(keys):
+                self.index.setdefault(str(key), (name, row))
+            self.sizes[name] = len(keys)
+            self.segments[name] = None
+
+    def forget(self, names):
+        """
+        Remove segments from the index.
+
+        :param names: set, names of the segments.
+        """
+        self.index = {key: value for key, value in self.index.items() if value[0] not in names}
+        for name in names:
+            del self.sizes[name]
+            del self.segments[name]
+
+    def open(self, name):
+        """
+        Memory-map the embeddings of a segment, or forget the segment if another process removed it.
+
+        :param name: string, name of the segment.
+        """
+        if self.segments[name] is None:
+            try:
+                self.segments[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+            except IOError:
+                self.forget({name})
+
+    def embed(self, chunks, batch_size=256):
+        """
+        Compute the embeddings of chunks, running the tower only on the chunks missing from the cache. A full segment
+        of new embeddings is saved.
+
+        :param chunks: 4D array, chunks x 40 x chunk_size x 1.
+        :param batch_size: int, batch size of the tower. Default is 256.
+        :return: 2D array, chunks x embedding size.
+        """
+        keys = [chunk_key(c) for c in chunks]
+        for name in {self.index[key][0] for key in keys if key in self.index} - {None}:
+            self.open(name)
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in self.index and key not in missing:
+                missing[key] = i
+        if missing:
+            embeddings = self.tower.predict(chunks[list(missing.values())], batch_size=batch_size)
+            for key, embedding in zip(missing, embeddings):
+                self.index[key] = (None, len(self.new_embeddings))
+                self.new_keys.append(key)
+                self.new_embeddings.append(embedding)
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+
+        X = np.empty((len(keys), self.tower.output_shape[-1]), dtype=np.float32)
+        for i, key in enumerate(keys):
+            name, row = self.index[key]
+            X[i] = self.new_embeddings[row] if name is None else self.segments[name][row]
+        if len(self.new_embeddings) >= self.segment_size:
+            self.save()
+        return X
+
+    def save(self):
+        """
+        Write the new embeddings as a segment, add the segments of the other processes to the index and remove the
+        oldest segments beyond max_embeddings.
+        """
+        if self.new_embeddings:
+            os.makedirs(self.path, exist_ok=True)
+            name = '{:013d}-{}'.format(int(time.time() * 1000), uuid.uuid4().hex)
+            # the keys are written last, so a segment is only listed once its embeddings are complete
+            for suffix, values in (('.npy', np.stack(self.new_embeddings)), ('.keys.npy', np.asarray(self.new_keys))):
+                path = os.path.join(self.path, name + suffix)
+                tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, values)
+                os.replace(tmp_path, path)
+            for row, key in enumerate(self.new_keys):
+                self.index[key] = (name, row)
+            self.sizes[name] = len(self.new_keys)
+            self.segments[name] = None
+            self.new_keys = []
+            self.new_embeddings = []
+        self.load()
+
+        if self.max_embeddings is None:
+            return
+        names = sorted(self.sizes)
+        total = sum(self.sizes.values())
+        removed = set()
+        # the newest segment is always kept
+        while total > self.max_embeddings and len(names) > 1:
+            name = names.pop(0)
+            total -= self.sizes[name]
+            removed.add(name)
+            for suffix in ('.keys.npy', '.npy'):
+                try:
+                    os.remove(os.path.join(self.path, name + suffix))
+                except OSError:  # removed by another process
+                    pass
+        if removed:
+            self.forget(removed)
+
+
+def predict_cached(head, cache, X, batch_size=32):
+    """
+    Predict songs from the cached embeddings of their chunks.
+
+    :param head: object, model of the head, see lstm_head().
+    :param cache: EmbeddingCache, cache of the tower of the same model.
+    :param X: 5D array, songs x n_chunks x 40 x chunk_size x 1.
+    :param batch_size: int, batch size of the head. Default is 32.
+    :return: 2D array, songs x 10 probabilities.
+    """
+    embeddings = cache.embed(X.reshape((-1,) + X.shape[2:]))
+    return head.predict(embeddings.reshape(X.shape[:2] + embeddings.shape[1:]), batch_size=batch_size)
@@ -0,0 +1,129 @@
+import argparse
+import os
+
+import numpy as np
+
+from preprocessing import chunk_tracks, compress, count_chunks, label_encoder, load_stats, n_samples, norm_moments, \
+    spec_len, spectrograms
+from embeddings import EmbeddingCache, lstm_head, predict_cached
+from train import chunk_tower, load_cnn
+
+genres = sorted(label_encoder, key=label_encoder.get)
+extensions = ('.au', '.wav', '.mp3', '.flac', '.ogg')
+
+
+def list_audio(paths):
+    """
+    List the audio files to be classified. Directories are walked in sorted order.
+
+    :param paths: list, paths to audio files or directories containing audio files.
+    :return: list, paths to the audio files.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(root + '/' + name for name in sorted(names) if name.lower().endswith(extensions))
+        else:
+            files.append(path)
+    return files
+
+
+def batches(files, batch_files=64, workers=None, cache_dir=None, chunk_size=80,
+            stats_path='./models/norm_stats.npz'):
+    """
+    Compute the normalized chunks of the files, grouped so that the chunks of many files are predicted together. The
+    normalization statistics of the train set are read once, before the first batch.
+
+    :param files: list, paths to the audio files.
+    :param batch_files: int, number of files per batch. Default is 64.
+    :param workers: int, number of worker processes computing the mel-spectrograms. Default is None, which uses all
+    the cores.
+    :param cache_dir: string, directory of the spectrogram cache. Default is None, which disables the cache.
+    :param chunk_size: int, number of frames per chunk. Default is 80.
+    :param stats_path: string, path to the normalization statistics of the train set, see preprocessing.save_stats().
+    Default is './models/norm_stats.npz'.
+    :return: generator, yielding tuples of the files of the batch and their chunks, files x n_chunks x 40 x chunk_size
+    x 1.
+    """
+    stats, band_stats, metadata = load_stats(stats_path)
+    mean, std = norm_moments(stats, band_stats, metadata['mode'])
+    names = []
+    spec = []
+    # the spectrograms are computed like those of the train set
+    spec_batch_size = 1 if metadata['engine'] == 'librosa' else 8
+    for i, (file, (s, _)) in enumerate(zip(files, spectrograms(files, workers, cache_dir, spec_batch_size,
+                                                               metadata['resampler']))):
+        names.append(file)
+        spec.append(s.reshape(1, *s.shape))
+        if len(names) == batch_files or i == len(files) - 1:
+            spec = compress(np.concatenate(spec))
+            spec -= mean
+            spec /= std
+            yield names, chunk_tracks(spec, chunk_size)
+            names = []
+            spec = []
+
+
+def predict(model, files, batch_files=64, batch_size=32, workers=None, cache_dir=None, embedding_cache=None,
+            chunk_size=80):
+    """
+    Predict the genre of each file.
+
+    :param model: object, model of the CNN.
+    :param files: list, paths to the audio files.
+    :param batch_files: int, number of files predicted in one call. Default is 64.
+    :param batch_size: int, batch size of the model. Default is 32.
+    :param workers: int, number of worker processes computing the mel-spectrograms. Default is None, which uses all
+    the cores.
+    :param cache_dir: string, directory of the spectrogram cache. Default is None, which disables the cache.
+    :param embedding_cache: EmbeddingCache, cache of the chunk embeddings of the model, see embeddings.py. Default is
+    None, which runs the whole model on every chunk.
+    :param chunk_size: int, number of frames per chunk the model was trained on. Default is 80.
+    :return: generator, yielding tuples of the file and its predicted label.
+    """
+    head = None if embedding_cache is None else lstm_head(model)
+    for names, X in batches(files, batch_files, workers, cache_dir, chunk_size):
+        if head is None:
+            prediction = model.predict(X, batch_size=batch_size)
+        else:
+            prediction = predict_cached(head, embedding_cache, X, batch_size)
+        for name, label in zip(names, np.argmax(prediction, axis=1)):
+            yield name, label
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Predict the genre of audio files.')
+    parser.add_argument('paths', nargs='+', help='audio files or directories containing audio files')
+    parser.add_argument('--channel', type=int, choices=[2, 3], default=3, help='number of channels of the CNN')
+    parser.add_argument('--fold', type=int, default=0, help='fold of the weights in ./models')
+    parser.add_argument('--weights', help='path to the weights, overrides --fold')
+    parser.add_argument('--gpus', type=int, default=2, help='number of GPUs the model was trained on')
+    parser.add_argument('--chunk-size', type=int, default=n_samples,
+                        help='frames per chunk the model was trained on with train.py --spec --chunk-size')
+    parser.add_argument('--lstm', choices=['cudnn', 'cpu'], default='cudnn',
+                        help='LSTM of the model, cpu runs without GPU with the weights converted by convert.py')
+    parser.add_argument('--batch-files', type=int, default=64, help='number of files predicted in one call')
+    parser.add_argument('--batch-size', type=int, default=32, help='batch size of the model')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes, default is the number of cores, 1 runs serially')
+    parser.add_argument('--cache-dir', default=None, help='directory of the spectrogram cache, default is no cache')
+    parser.add_argument('--embedding-cache', default=None,
+                        help='directory of the chunk embedding cache, e.g. ./models/embeddings, default is no cache')
+    parser.add_argument('--embedding-cache-size', type=int, default=1000000,
+                        help='number of embeddings above which the oldest ones are removed from the cache')
+    args = parser.parse_args()
+
+    weights_path = args.weights or './models/cnn_weights_{}{}.h5'.format(args.fold,
+                                                                         '_cpu' if args.lstm == 'cpu' else '')
+    model = load_cnn(args.channel, weights_path, args.gpus, args.chunk_size, count_chunks(spec_len, args.chunk_size),
+                     args.lstm)
+    embedding_cache = None if args.embedding_cache is None else EmbeddingCache(
+        chunk_tower(model), args.embedding_cache, max_embeddings=args.embedding_cache_size)
+    for name, label in predict(model, list_audio(args.paths), args.batch_files, args.batch_size, args.workers,
+                               args.cache_dir, embedding_cache, args.chunk_size):
+        print('{}\t{}'.format(name, genres[label]))
+    if embedding_cache is not None:
+        embedding_cache.save()
+        print('Embedding cache: {} hits, {} misses'.format(embedding_cache.hits, embedding_cache.misses))
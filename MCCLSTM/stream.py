@@ -0,0 +1,165 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from predict import genres
+from preprocessing import count_chunks, hop_length, n_samples, sr, spec_len, stream_chunks
+from train import chunk_tower, load_cnn, lstm_step
+
+
+def timeline(tower, step, file, reset_every=16, batch_chunks=16, hop=None, block_duration=10., resampler=None,
+             chunk_size=80):
+    """
+    Classify an audio file of any length incrementally. Each chunk goes through the CNN tower once, in batches of
+    chunks as they come out of the stream, and its embedding is fed to the stateful LSTM step, which carries its
+    hidden state forward. A new chunk therefore costs one tower pass and one LSTM step, instead of the 16 towers of
+    the whole sequence.
+
+    :param tower: object, model of the CNN tower, see train.chunk_tower().
+    :param step: object, stateful model of the LSTM step, see train.lstm_step().
+    :param file: string, path to the audio file.
+    :param reset_every: int, number of chunks after which the hidden state is reset. With the default of 16, the
+    prediction at the end of every 16 chunks is the one of the trained model on those chunks. None carries the state
+    over the whole file. Default is 16.
+    :param batch_chunks: int, number of chunks whose embeddings are computed in one call. Default is 16.
+    :param hop: int, number of frames between the start of consecutive chunks, at most chunk_size. Default is None,
+    which gives non-overlapping chunks.
+    :param block_duration: float, number of seconds of audio read at a time. Default is 10.
+    :param resampler: string, 'best' or 'fast', see preprocessing.resample(). Default is None, which is the resampler
+    of the train set.
+    :param chunk_size: int, number of frames per chunk the model was trained on. Default is 80.
+    :return: generator, yielding tuples of the time in seconds of the end of the chunk, the predicted label and the
+    probability of each genre.
+    """
+    step.reset_states()
+    n_steps = 0
+
+    def predict(starts, X):
+        nonlocal n_steps
+        embeddings = tower.predict(np.stack(X), batch_size=len(X))
+        for start, embedding in zip(starts, embeddings):
+            if reset_every and n_steps == reset_every:
+                step.reset_states()
+                n_steps = 0
+            probabilities = step.predict(embedding.reshape(1, 1, -1), batch_size=1)[0]
+            n_steps += 1
+            yield (start + chunk_size) * hop_length / sr, np.argmax(probabilities), probabilities
+
+    starts = []
+    X = []
+    for start, c in stream_chunks(file, chunk_size, hop, block_duration, resampler):
+        starts.append(start)
+        X.append(c)
+        if len(X) == batch_chunks:
+            yield from predict(starts, X)
+            starts = []
+            X = []
+    if X:
+        yield from predict(starts, X)
+
+
+def step_parity(model, tower, step, n_songs=4, seed=0):
+    """
+    Compare the stateful step with the model on random songs. After reset_states(), the embeddings of the n_chunks
+    chunks of a song fed one by one must give the prediction of the model on the whole song.
+
+    :param model: object, single-device model returned by train.load_cnn().
+    :param tower: object, model of the CNN tower of the model, see train.chunk_tower().
+    :param step: object, stateful model of the LSTM step of the model, see train.lstm_step().
+    :param n_songs: int, number of random songs. Default is 4.
+    :param seed: int, seed of the random songs. Default is 0.
+    :return: float, largest absolute difference of the probabilities.
+    """
+    X = np.random.RandomState(seed).randn(n_songs, *model.input_shape[1:]).astype(np.float32)
+    difference = 0.
+    for song, expected in zip(X, model.predict(X)):
+        step.reset_states()
+        for embedding in tower.predict(song):
+            probabilities = step.predict(embedding.reshape(1, 1, -1), batch_size=1)[0]
+        difference = max(difference, float(np.max(np.abs(probabilities - expected))))
+    step.reset_states()
+    return difference
+
+
+def segments(points):
+    """
+    Merge the consecutive points of a timeline with the same genre.
+
+    :param points: iterable, tuples of the time in seconds, the label and the probabilities, see timeline().
+    :return: generator, yielding tuples of the start and end time in seconds of each segment and its label.
+    """
+    start = 0.
+    end = None
+    current = None
+    for end_time, label, _ in points:
+        if current is not None and label != current:
+            yield start, end, current
+            start = end
+        current = label
+        end = end_time
+    if current is not None:
+        yield start, end, current
+
+
+def format_time(seconds):
+    """
+    :param seconds: float, time in seconds.
+    :return: string, time as hours:minutes:seconds.
+    """
+    return time.strftime('%H:%M:%S', time.gmtime(seconds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the genre timeline of a long audio file, chunk by chunk.')
+    parser.add_argument('file', help='audio file of any length')
+    parser.add_argument('--channel', type=int, choices=[2, 3], default=3, help='number of channels of the CNN')
+    parser.add_argument('--fold', type=int, default=0, help='fold of the weights in ./models')
+    parser.add_argument('--weights', help='path to the weights, overrides --fold')
+    parser.add_argument('--gpus', type=int, default=2, help='number of GPUs the model was trained on')
+    parser.add_argument('--chunk-size', type=int, default=n_samples,
+                        help='frames per chunk the model was trained on with train.py --spec --chunk-size')
+    parser.add_argument('--lstm', choices=['cudnn', 'cpu'], default='cudnn',
+                        help='LSTM of the model, cpu runs without GPU with the weights converted by convert.py')
+    parser.add_argument('--reset-every', type=int, default=None,
+                        help='chunks after which the LSTM state is reset, default is the length of the training '
+                             'sequences, 16 chunks of 80 frames, 0 never resets it')
+    parser.add_argument('--hop', type=int, default=None,
+                        help='frames between consecutive chunks, default is the chunk size, less gives overlapping '
+                             'chunks')
+    parser.add_argument('--batch-chunks', type=int, default=16,
+                        help='number of chunks whose embeddings are computed in one call')
+    parser.add_argument('--block-duration', type=float, default=10., help='seconds of audio read at a time')
+    parser.add_argument('--resampler', choices=['best', 'fast'], default=None,
+                        help='resampler of the files whose sampling rate is not 44.1 kHz, default is the one of the '
+                             'train set')
+    parser.add_argument('--segments', action='store_true',
+                        help='print the segments of consecutive chunks with the same genre instead of every chunk')
+    parser.add_argument('--check', action='store_true',
+                        help='check that the LSTM step reproduces the model on random songs before streaming')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='largest difference of the probabilities')
+    args = parser.parse_args()
+    if args.hop is not None and not 0 < args.hop <= args.chunk_size:
+        parser.error('--hop must be between 1 and {}'.format(args.chunk_size))
+    n_chunks = count_chunks(spec_len, args.chunk_size)
+
+    weights_path = args.weights or './models/cnn_weights_{}{}.h5'.format(args.fold,
+                                                                         '_cpu' if args.lstm == 'cpu' else '')
+    model = load_cnn(args.channel, weights_path, args.gpus, args.chunk_size, n_chunks, args.lstm)
+    tower = chunk_tower(model)
+    step = lstm_step(model)
+    if args.check:
+        difference = step_parity(model, tower, step)
+        print('Largest difference of the probabilities: {:.2e}'.format(difference), file=sys.stderr)
+        if difference > args.tolerance:
+            sys.exit('Parity check failed')
+    reset_every = n_chunks if args.reset_every is None else args.reset_every or None
+    points = timeline(tower, step, args.file, reset_every, args.batch_chunks, args.hop, args.block_duration,
+                      args.resampler, args.chunk_size)
+    if args.segments:
+        for start, end, label in segments(points):
+            print('{}\t{}\t{}'.format(format_time(start), format_time(end), genres[label]))
+    else:
+        for end, label, probabilities in points:
+            print('{}\t{}\t{:.2f}'.format(format_time(end), genres[label], probabilities[label]))